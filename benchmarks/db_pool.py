@@ -0,0 +1,72 @@
+"""数据库连接池基准测试：每次调用新建连接（旧实现）与从连接池借用长连接的单次调用耗时对比。
+
+用法（在仓库根目录运行）：
+    python benchmarks/db_pool.py [调用次数]
+"""
+import asyncio
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import aiosqlite
+from database.db_manager import DatabaseManager
+
+SELECT_USER = 'SELECT * FROM users WHERE user_id = ?'
+SELECT_BLACKLIST = 'SELECT permanent FROM blacklist WHERE user_id = ?'
+INSERT_MESSAGE = '''
+    INSERT INTO messages (user_id, message_id, content, media_type, direction)
+    VALUES (?, ?, ?, ?, ?)
+'''
+
+async def _per_call_connection(manager, sql, params, write):
+    # 旧实现：每次调用打开一个新连接（以及一个新的 aiosqlite 线程）
+    async with aiosqlite.connect(manager.db_path) as db:
+        async with db.execute(sql, params) as cursor:
+            await cursor.fetchall()
+        if write:
+            await db.commit()
+
+async def _pooled_connection(manager, sql, params, write):
+    async with manager.get_connection() as db:
+        async with db.execute(sql, params) as cursor:
+            await cursor.fetchall()
+        if write:
+            await db.commit()
+
+async def _measure(call, manager, sql, params_for, write, calls):
+    start = time.perf_counter()
+    for i in range(calls):
+        await call(manager, sql, params_for(i), write)
+    return (time.perf_counter() - start) / calls * 1e6
+
+async def main(calls: int):
+    with tempfile.TemporaryDirectory() as directory:
+        manager = DatabaseManager()
+        manager.db_path = os.path.join(directory, 'bench.db')
+        await manager.initialize()
+        try:
+            async with manager.get_connection() as db:
+                await db.executemany(
+                    'INSERT INTO users (user_id, username, first_name) VALUES (?, ?, ?)',
+                    [(i, f'user{i}', 'bench') for i in range(1000)]
+                )
+                await db.commit()
+
+            cases = (
+                ('get_user', SELECT_USER, lambda i: (i % 1000,), False),
+                ('is_blacklisted', SELECT_BLACKLIST, lambda i: (i % 1000,), False),
+                ('save_message', INSERT_MESSAGE, lambda i: (i % 1000, i, 'bench', 'text', 'incoming'), True),
+            )
+            print(f"{calls} 次顺序调用，单次耗时（微秒）:")
+            for name, sql, params_for, write in cases:
+                before = await _measure(_per_call_connection, manager, sql, params_for, write, calls)
+                after = await _measure(_pooled_connection, manager, sql, params_for, write, calls)
+                print(f"  {name:15s} 每次新建连接 {before:8.1f}  连接池 {after:8.1f}  ({before / after:.1f}x)")
+        finally:
+            await manager.close()
+
+if __name__ == '__main__':
+    asyncio.run(main(int(sys.argv[1]) if len(sys.argv) > 1 else 500))
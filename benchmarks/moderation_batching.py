@@ -0,0 +1,149 @@
+"""批量审查基准测试：通过 handle_message 测量纯文本消息的端到端耗时与实际形成的批次。
+
+提供商替换为固定延迟的本地实现，Telegram Bot 使用 AsyncMock，不访问网络。分别测量：
+  - 逐条处理（一次只有一条消息在审查）时的单条耗时：旧实现总要等待 AI_BATCH_WAIT_MS 凑批，
+    现在同一模型空闲时立即发出；
+  - 多个用户同时发消息时的耗时与批次数。
+
+用法（在仓库根目录运行）：
+    python benchmarks/moderation_batching.py [消息数]
+"""
+import asyncio
+import os
+import sys
+import tempfile
+import time
+from types import SimpleNamespace
+from unittest.mock import AsyncMock, MagicMock
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault('BOT_TOKEN', 'bench')
+os.environ.setdefault('FORUM_GROUP_ID', '-100')
+os.environ['GEMINI_API_KEY'] = 'bench'
+os.environ['CHALLENGE_POOL_SIZE'] = '0'
+os.environ['AI_HEDGE_ENABLED'] = 'false'
+os.environ['MAX_MESSAGES_PER_MINUTE'] = '1000000'
+# 只测量审查耗时，发送限速放到足够大
+os.environ['OUTBOUND_GLOBAL_RATE'] = '1000000'
+os.environ['OUTBOUND_PRIVATE_RATE'] = '1000000'
+os.environ['OUTBOUND_GROUP_RATE_PER_MINUTE'] = '1000000000'
+
+from config import config
+from database.db_manager import DatabaseManager
+from database.write_queue import write_queue
+from handlers.user_handler import handle_message
+from services import ai_service as ai_module
+from services.ai_service import GeminiProvider, ai_service
+from services.metrics import metrics
+
+PROVIDER_LATENCY = 0.05
+
+class FakeProvider(GeminiProvider):
+    """固定延迟、总是判定为正常的提供商"""
+
+    def __init__(self):
+        super().__init__(None)
+        self.requests = 0
+
+    async def analyze_message(self, text, image_bytes=None, model_name=None):
+        self.requests += 1
+        await asyncio.sleep(PROVIDER_LATENCY)
+        return {"is_spam": False, "reason": "内容未发现违规。", "confidence": 95}
+
+    async def analyze_batch(self, texts, model_name=None):
+        self.requests += 1
+        await asyncio.sleep(PROVIDER_LATENCY)
+        return [{"is_spam": False, "reason": "内容未发现违规。", "confidence": 95} for _ in texts]
+
+class _AlwaysBusy(dict):
+    """模拟旧实现：不论是否有进行中的请求，总是等待 max_wait 凑批"""
+
+    def get(self, key, default=None):
+        return 1
+
+def _sent_message(**kwargs):
+    return SimpleNamespace(
+        message_id=1,
+        message_thread_id=kwargs.get('message_thread_id'),
+        edit_text=AsyncMock(),
+        delete=AsyncMock(),
+    )
+
+def _make_update(user_id: int, index: int):
+    message = MagicMock()
+    message.text = f"用户 {user_id} 的第 {index} 条消息，询问订单 {index * 7919} 的发货进度"
+    message.caption = None
+    message.photo = None
+    message.sticker = None
+    message.video = None
+    message.animation = None
+    message.entities = ()
+    message.message_id = index
+    message.chat_id = user_id
+    message.reply_text = AsyncMock()
+    user = SimpleNamespace(id=user_id, first_name='bench', last_name=None, username=None, language_code='zh')
+    return SimpleNamespace(update_id=index, effective_user=user, message=message)
+
+def _make_context():
+    bot = AsyncMock()
+    bot.send_message.side_effect = _sent_message
+    return SimpleNamespace(bot=bot, user_data={})
+
+async def _sequential(count: int, user_id: int) -> float:
+    context = _make_context()
+    start = time.perf_counter()
+    for i in range(count):
+        await handle_message(_make_update(user_id, i), context)
+    return (time.perf_counter() - start) / count * 1000
+
+async def _concurrent(count: int, first_user: int) -> float:
+    start = time.perf_counter()
+    await asyncio.gather(*(
+        handle_message(_make_update(first_user + i, i), _make_context()) for i in range(count)
+    ))
+    return (time.perf_counter() - start) * 1000
+
+async def main(count: int):
+    batcher = ai_module.moderation_batcher
+    provider = FakeProvider()
+    ai_service._providers[('gemini', config.GEMINI_API_KEY, None)] = provider
+
+    with tempfile.TemporaryDirectory() as directory:
+        manager = DatabaseManager()
+        manager.db_path = os.path.join(directory, 'bench.db')
+        await manager.initialize()
+        try:
+            async with manager.get_connection() as db:
+                await db.executemany(
+                    'INSERT INTO users (user_id, first_name, is_verified, thread_id) VALUES (?, ?, 1, ?)',
+                    [(user_id, 'bench', user_id) for user_id in range(1, 4 * count + 2)]
+                )
+                await db.commit()
+
+            print(f"提供商延迟 {PROVIDER_LATENCY * 1000:.0f} ms，AI_BATCH_WAIT_MS={batcher.max_wait * 1000:.0f}，"
+                  f"AI_BATCH_MAX_SIZE={batcher.max_batch}")
+            print(f"逐条处理 {count} 条消息，单条 handle_message 耗时（毫秒）:")
+            cases = (
+                ('不批量', 1, {}),
+                ('旧实现（总是等待凑批）', config.AI_BATCH_MAX_SIZE, _AlwaysBusy()),
+                ('空闲时立即发出', config.AI_BATCH_MAX_SIZE, {}),
+            )
+            for offset, (name, max_batch, in_flight) in enumerate(cases):
+                batcher.max_batch, batcher._in_flight = max_batch, in_flight
+                latency = await _sequential(count, offset + 1)
+                print(f"  {name:24s} {latency:8.1f}")
+
+            batcher.max_batch, batcher._in_flight = config.AI_BATCH_MAX_SIZE, {}
+            print(f"{count} 个用户同时发送一条消息:")
+            for name, max_batch, first_user in (('不批量', 1, 10), ('批量', config.AI_BATCH_MAX_SIZE, 10 + 2 * count)):
+                batcher.max_batch = max_batch
+                requests, batches = provider.requests, metrics.count('moderation.batches')
+                elapsed = await _concurrent(count, first_user)
+                print(f"  {name:24s} 总耗时 {elapsed:8.1f} ms  提供商请求 {provider.requests - requests:4d}  "
+                      f"批次 {metrics.count('moderation.batches') - batches:4d}")
+        finally:
+            await write_queue.close()
+            await manager.close()
+
+if __name__ == '__main__':
+    asyncio.run(main(int(sys.argv[1]) if len(sys.argv) > 1 else 50))
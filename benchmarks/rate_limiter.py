@@ -0,0 +1,90 @@
+"""限流器基准测试：10 万个不同用户时单次检查的耗时、内存与过期条目的清理。
+
+限流状态保存在进程内会话存储中，每次写入时从按过期时间排列的堆顶顺带清理有限个已过期的条目。测量：
+  - 跟踪的用户数从 1 万增长到 10 万时，每 1 万次检查的平均耗时（应保持平稳）以及内存占用；
+  - 旧条目陆续过期、新用户持续到来时，每次检查顺带清理少量过期条目，跟踪用户数和堆大小不再增长；
+  - 时间直接推进 60 秒后（10 万个条目同时过期），积压随后续检查逐步清完，
+    任何一次检查都不会一次清理全部积压。
+
+时间使用模拟时钟，不需要真的等待；每个用户发一条消息后约 2 秒（60 / 每分钟上限 30）恢复并过期。
+
+用法（在仓库根目录运行）：
+    python benchmarks/rate_limiter.py [用户数]
+"""
+import asyncio
+import os
+import sys
+import time
+import tracemalloc
+from unittest import mock
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault('BOT_TOKEN', 'bench')
+
+from database.session_store import MemorySessionStore
+from services.rate_limiter import RateLimiter
+
+STEP = 10000
+# 模拟时钟在两次检查之间前进的秒数：10 万个用户在 1 秒内到达，都仍在各自的限流窗口内
+TICK = 0.00001
+
+class Clock:
+    def __init__(self):
+        self.now = 1_700_000_000.0
+
+    def __call__(self):
+        return self.now
+
+async def _check_range(limiter, clock, first: int, count: int):
+    """检查 count 个新用户，返回 (平均耗时微秒, 最慢一次耗时微秒)"""
+    total = slowest = 0.0
+    for user_id in range(first, first + count):
+        clock.now += TICK
+        start = time.perf_counter()
+        await limiter.check_user_rate_limit(user_id)
+        elapsed = time.perf_counter() - start
+        total += elapsed
+        slowest = max(slowest, elapsed)
+    return total / count * 1e6, slowest * 1e6
+
+def _new_limiter(users: int):
+    store = MemorySessionStore(max_entries=users * 2)
+    return store, RateLimiter(max_messages_per_minute=30, store=store)
+
+def _print_range(store, mean: float, slowest: float):
+    group = store._kinds[RateLimiter.KIND]
+    print(f"  跟踪 {len(group.entries):7d} 个用户  堆 {len(group.heap):7d}  "
+          f"平均 {mean:6.2f} µs  最慢 {slowest:8.1f} µs")
+
+async def main(users: int):
+    clock = Clock()
+    with mock.patch('time.time', clock):
+        store, limiter = _new_limiter(users)
+        print(f"写入 {users} 个不同用户，每 {STEP} 次检查:")
+        for first in range(0, users, STEP):
+            _print_range(store, *await _check_range(limiter, clock, first, STEP))
+
+        # 第一批用户在第 0~1 秒到达、第 2~3 秒过期；从第 2 秒起新用户到来的同时旧用户逐个过期
+        print("旧用户陆续过期，新用户以相同速度到来:")
+        clock.now += 1
+        for first in range(users, 2 * users, STEP):
+            _print_range(store, *await _check_range(limiter, clock, first, STEP))
+
+        print(f"时间推进 60 秒（{len(store._kinds[RateLimiter.KIND].entries)} 个条目同时过期）后继续检查新用户:")
+        clock.now += 60
+        for first in range(2 * users, 2 * users + 2 * STEP, STEP):
+            _print_range(store, *await _check_range(limiter, clock, first, STEP))
+        stats = store.stats()
+        print(f"  累计清理过期条目 {stats['expired']}，因超出上限淘汰 {stats['evicted']}")
+
+        # 内存单独测量，tracemalloc 会拖慢上面的计时
+        store, limiter = _new_limiter(users)
+        tracemalloc.start()
+        await _check_range(limiter, clock, 0, users)
+        current, _ = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        print(f"{users} 个用户的限流状态占用内存约 {current / 1024 / 1024:.1f} MB"
+              f"（每个用户约 {current / users:.0f} 字节）")
+
+if __name__ == '__main__':
+    asyncio.run(main(int(sys.argv[1]) if len(sys.argv) > 1 else 100000))
@@ -6,12 +6,29 @@ from config import config
 from handlers import register_handlers
 from rss import setup as setup_rss
 from database.db_manager import DatabaseManager
+from database.write_queue import write_queue
+from services.ai_service import ai_service
+from services.challenge_pool import challenge_pool
+from services.captcha_engine import captcha_engine
+from services.local_filter import local_filter
 
 async def post_init(app: Application):
     config.BOT_ID = app.bot.id
     config.BOT_USERNAME = app.bot.username
     print(f"Bot ID: {config.BOT_ID} 已设置")
     print(f"Bot Username: {config.BOT_USERNAME} 已设置")
+    # 启动时在后台预生成验证问题
+    challenge_pool.start()
+    captcha_engine.start()
+
+async def post_shutdown(app: Application):
+    # 先停掉仍可能访问数据库的后台任务，再刷新写队列、关闭连接池
+    await challenge_pool.close()
+    await local_filter.close()
+    await captcha_engine.close()
+    await ai_service.close()
+    await write_queue.close()
+    await DatabaseManager().close()
 
 def main():
     logging.basicConfig(
@@ -22,7 +39,7 @@ def main():
     db_manager = DatabaseManager(config.DATABASE_PATH)
     asyncio.run(db_manager.initialize())
     
-    app = Application.builder().token(config.BOT_TOKEN).post_init(post_init).build()
+    app = Application.builder().token(config.BOT_TOKEN).post_init(post_init).post_shutdown(post_shutdown).build()
     
     register_handlers(app)
     setup_rss(app)
@@ -21,6 +21,8 @@ class Config:
     VERIFICATION_ENABLED = os.getenv('VERIFICATION_ENABLED', 'true').lower() == 'true'
     VERIFICATION_USE_IMAGE = os.getenv('VERIFICATION_USE_IMAGE', 'false').lower() == 'true'
     VERIFICATION_IMAGE_CAPTCHA_TYPE = os.getenv('VERIFICATION_IMAGE_CAPTCHA_TYPE', 'mixed')  # 'digits', 'letters', 'mixed'
+    CAPTCHA_RING_SIZE = int(os.getenv('CAPTCHA_RING_SIZE', '10'))
+    CAPTCHA_RENDER_WORKERS = int(os.getenv('CAPTCHA_RENDER_WORKERS', '2'))
     VERIFICATION_USE_CLOUDFLARE = os.getenv('VERIFICATION_USE_CLOUDFLARE', 'false').lower() == 'true'
     CLOUDFLARE_TURNSTILE_SITE_KEY = os.getenv('CLOUDFLARE_TURNSTILE_SITE_KEY')
     CLOUDFLARE_TURNSTILE_SECRET_KEY = os.getenv('CLOUDFLARE_TURNSTILE_SECRET_KEY')
@@ -28,12 +30,61 @@ class Config:
     AUTO_UNBLOCK_ENABLED = os.getenv('AUTO_UNBLOCK_ENABLED', 'true').lower() == 'true'
     
     DATABASE_PATH = os.getenv('DATABASE_PATH', './data/bot.db')
+    DATABASE_POOL_SIZE = int(os.getenv('DATABASE_POOL_SIZE', '4'))
+    DB_WRITE_BATCH_SIZE = int(os.getenv('DB_WRITE_BATCH_SIZE', '200'))
+    DB_WRITE_FLUSH_INTERVAL_MS = int(os.getenv('DB_WRITE_FLUSH_INTERVAL_MS', '50'))
+    USER_CACHE_SIZE = int(os.getenv('USER_CACHE_SIZE', '10000'))
+    USER_CACHE_TTL = int(os.getenv('USER_CACHE_TTL', '300'))
+    
+    VERDICT_CACHE_SIZE = int(os.getenv('VERDICT_CACHE_SIZE', '5000'))
+    VERDICT_CACHE_TTL = int(os.getenv('VERDICT_CACHE_TTL', '86400'))
+    VERDICT_CACHE_PERSIST = os.getenv('VERDICT_CACHE_PERSIST', 'true').lower() == 'true'
+    MODERATION_IMAGE_MAX_SIDE = int(os.getenv('MODERATION_IMAGE_MAX_SIDE', '800'))
+    MODERATION_IMAGE_QUALITY = int(os.getenv('MODERATION_IMAGE_QUALITY', '85'))
+    MEDIA_CACHE_MAX_BYTES = int(os.getenv('MEDIA_CACHE_MAX_BYTES', str(32 * 1024 * 1024)))
+    
+    LOCAL_FILTER_ENABLED = os.getenv('LOCAL_FILTER_ENABLED', 'true').lower() == 'true'
+    LOCAL_FILTER_KEYWORDS = [kw.strip() for kw in os.getenv('LOCAL_FILTER_KEYWORDS', '').split(',') if kw.strip()]  # 以 re: 开头的项按正则处理
+    LOCAL_FILTER_BLOCKED_DOMAINS = [d.strip().lower() for d in os.getenv('LOCAL_FILTER_BLOCKED_DOMAINS', '').split(',') if d.strip()]
+    LOCAL_FILTER_SPAM_THRESHOLD = float(os.getenv('LOCAL_FILTER_SPAM_THRESHOLD', '0.99'))
+    LOCAL_FILTER_HAM_THRESHOLD = float(os.getenv('LOCAL_FILTER_HAM_THRESHOLD', '0.01'))
+    LOCAL_FILTER_MIN_SAMPLES = int(os.getenv('LOCAL_FILTER_MIN_SAMPLES', '50'))
+    LOCAL_FILTER_RETRAIN_INTERVAL = int(os.getenv('LOCAL_FILTER_RETRAIN_INTERVAL', '600'))
+    
+    AI_INPUT_MAX_TOKENS = int(os.getenv('AI_INPUT_MAX_TOKENS', '1000'))
+    AI_JSON_FIELD_MAX_CHARS = int(os.getenv('AI_JSON_FIELD_MAX_CHARS', '2000'))
+    
+    AI_BATCH_MAX_SIZE = int(os.getenv('AI_BATCH_MAX_SIZE', '8'))
+    AI_BATCH_WAIT_MS = int(os.getenv('AI_BATCH_WAIT_MS', '20'))
     
     MAX_WORKERS = int(os.getenv('MAX_WORKERS', '5'))
     QUEUE_TIMEOUT = int(os.getenv('QUEUE_TIMEOUT', '30'))
+    AI_CALL_TIMEOUT = int(os.getenv('AI_CALL_TIMEOUT', '20'))
+    AI_SLOW_CALL_SECONDS = int(os.getenv('AI_SLOW_CALL_SECONDS', '10'))
+    AI_BREAKER_FAILURE_THRESHOLD = int(os.getenv('AI_BREAKER_FAILURE_THRESHOLD', '5'))
+    AI_BREAKER_COOLDOWN = int(os.getenv('AI_BREAKER_COOLDOWN', '30'))
+    AI_HEDGE_ENABLED = os.getenv('AI_HEDGE_ENABLED', 'false').lower() == 'true'
+    AI_HEDGE_AFTER_MS = int(os.getenv('AI_HEDGE_AFTER_MS', '0'))
+    
+    AUTOREPLY_TOP_K = int(os.getenv('AUTOREPLY_TOP_K', '3'))
+    AUTOREPLY_MIN_SCORE = float(os.getenv('AUTOREPLY_MIN_SCORE', '0.5'))
+    AUTOREPLY_CACHE_SIZE = int(os.getenv('AUTOREPLY_CACHE_SIZE', '1000'))
+    AUTOREPLY_CACHE_TTL = int(os.getenv('AUTOREPLY_CACHE_TTL', '86400'))
+    AUTOREPLY_STREAMING = os.getenv('AUTOREPLY_STREAMING', 'true').lower() == 'true'
+    AUTOREPLY_STREAM_EDIT_INTERVAL = float(os.getenv('AUTOREPLY_STREAM_EDIT_INTERVAL', '1.0'))
     
     VERIFICATION_TIMEOUT = int(os.getenv('VERIFICATION_TIMEOUT', '300'))
     MAX_VERIFICATION_ATTEMPTS = int(os.getenv('MAX_VERIFICATION_ATTEMPTS', '3'))
+    STATE_BACKEND = os.getenv('STATE_BACKEND', 'memory').lower()  # 'memory' 或 'sqlite'
+    SESSION_STORE_MAX_ENTRIES = int(os.getenv('SESSION_STORE_MAX_ENTRIES', '50000'))
+    CHALLENGE_POOL_SIZE = int(os.getenv('CHALLENGE_POOL_SIZE', '20'))
+    CHALLENGE_POOL_CONCURRENCY = int(os.getenv('CHALLENGE_POOL_CONCURRENCY', '2'))
+    
+    OUTBOUND_GLOBAL_RATE = float(os.getenv('OUTBOUND_GLOBAL_RATE', '30'))
+    OUTBOUND_PRIVATE_RATE = float(os.getenv('OUTBOUND_PRIVATE_RATE', '1'))
+    OUTBOUND_GROUP_RATE_PER_MINUTE = float(os.getenv('OUTBOUND_GROUP_RATE_PER_MINUTE', '20'))
+    
+    TOPIC_STATE_TTL = int(os.getenv('TOPIC_STATE_TTL', '3600'))
     
     MAX_MESSAGES_PER_MINUTE = int(os.getenv('MAX_MESSAGES_PER_MINUTE', '30'))
 
@@ -0,0 +1,75 @@
+import time
+from collections import OrderedDict
+from config import config
+
+_MISSING = object()
+
+class UserStateCache:
+    """用户状态读缓存（按用户 LRU + 每项 TTL），放在 models 的高频读取前面。
+
+    所有写入路径都必须调用 invalidate()。读取前先记下 epoch，
+    写回时若期间发生过失效则放弃写回，避免把旧值重新放进缓存。
+    """
+
+    MISSING = _MISSING
+
+    def __init__(self, max_entries: int = 10000, ttl: float = 300):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._data = OrderedDict()
+        self._epoch = 0
+        self.hits = 0
+        self.misses = 0
+
+    @property
+    def epoch(self) -> int:
+        return self._epoch
+
+    def get(self, kind: str, user_id: int):
+        entries = self._data.get(user_id)
+        if entries is not None:
+            entry = entries.get(kind)
+            if entry is not None:
+                value, expires_at = entry
+                if expires_at > time.monotonic():
+                    self._data.move_to_end(user_id)
+                    self.hits += 1
+                    return value
+                del entries[kind]
+        self.misses += 1
+        return _MISSING
+
+    def set(self, kind: str, user_id: int, value, epoch: int):
+        if self.max_entries <= 0 or epoch != self._epoch:
+            return
+        entries = self._data.get(user_id)
+        if entries is None:
+            entries = self._data[user_id] = {}
+        entries[kind] = (value, time.monotonic() + self.ttl)
+        self._data.move_to_end(user_id)
+        while len(self._data) > self.max_entries:
+            self._data.popitem(last=False)
+
+    def invalidate(self, user_id: int):
+        self._epoch += 1
+        self._data.pop(user_id, None)
+
+    def invalidate_kind(self, kind: str):
+        self._epoch += 1
+        for entries in self._data.values():
+            entries.pop(kind, None)
+
+    def clear(self):
+        self._epoch += 1
+        self._data.clear()
+
+    def stats(self) -> dict:
+        total = self.hits + self.misses
+        return {
+            "users": len(self._data),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / total if total else 0.0,
+        }
+
+user_cache = UserStateCache(config.USER_CACHE_SIZE, config.USER_CACHE_TTL)
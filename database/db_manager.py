@@ -1,26 +1,122 @@
 import aiosqlite
+import asyncio
 import os
 import logging
+from contextlib import asynccontextmanager
 from datetime import datetime
+from config import config
 
 class DatabaseManager:
     _instance = None
 
+    # 每个连接的页缓存大小（KiB，对应 PRAGMA cache_size 的负值写法）
+    CACHE_SIZE_KB = 8192
+    BUSY_TIMEOUT_MS = 5000
+
     def __new__(cls, db_path='./data/bot.db'):
         if cls._instance is None:
             cls._instance = super(DatabaseManager, cls).__new__(cls)
             cls._instance.db_path = db_path
+            cls._instance.pool_size = max(1, config.DATABASE_POOL_SIZE)
+            cls._instance._pool = None
+            cls._instance._pool_loop = None
+            cls._instance._connections = []
+            cls._instance._created = 0
+            cls._instance._closed = False
             cls._instance.ensure_data_directory()
         return cls._instance
 
     def ensure_data_directory(self):
         os.makedirs(os.path.dirname(self.db_path), exist_ok=True)
 
-    def get_connection(self):
-        return aiosqlite.connect(self.db_path)
+    async def _open_connection(self):
+        conn = await aiosqlite.connect(self.db_path)
+        await conn.execute('PRAGMA journal_mode=WAL')
+        await conn.execute('PRAGMA synchronous=NORMAL')
+        await conn.execute(f'PRAGMA cache_size=-{self.CACHE_SIZE_KB}')
+        await conn.execute(f'PRAGMA busy_timeout={self.BUSY_TIMEOUT_MS}')
+        await conn.execute('PRAGMA temp_store=MEMORY')
+        return conn
+
+    async def _acquire(self):
+        if self._closed:
+            # 关闭后不再悄悄重建连接池，否则新连接的 aiosqlite 线程没人关闭，进程无法退出
+            raise RuntimeError("数据库连接池已关闭")
+        loop = asyncio.get_running_loop()
+        if self._pool_loop is not loop:
+            # 连接池与事件循环绑定（bot.py 中初始化与轮询使用不同的事件循环）
+            await self._close_connections(self._connections)
+            self._connections = []
+            self._created = 0
+            self._pool = asyncio.Queue()
+            self._pool_loop = loop
+
+        if self._pool.empty() and self._created < self.pool_size:
+            # 先计数再建立连接，避免并发请求超额创建
+            self._created += 1
+            try:
+                conn = await self._open_connection()
+            except Exception:
+                self._created -= 1
+                raise
+            self._connections.append(conn)
+            return conn
+
+        pool = self._pool
+        conn = await pool.get()
+        if conn is None:
+            # close() 放入的哨兵：传给下一个等待者后报错
+            pool.put_nowait(None)
+            raise RuntimeError("数据库连接池已关闭")
+        return conn
+
+    async def _release(self, conn):
+        if self._pool is None or conn not in self._connections:
+            # 连接池已被关闭或重建，直接关闭这个游离连接
+            await conn.close()
+            return
+        if conn.in_transaction:
+            # 调用方在提交前出错时，避免把未完成的事务带给下一个使用者
+            await conn.rollback()
+        self._pool.put_nowait(conn)
+
+    @asynccontextmanager
+    async def get_connection(self):
+        """从连接池借出一个长连接，离开上下文时归还。"""
+        conn = await self._acquire()
+        try:
+            yield conn
+        finally:
+            await self._release(conn)
+
+    async def _close_connections(self, connections):
+        for conn in connections:
+            try:
+                await conn.close()
+            except Exception as e:
+                logging.warning(f"关闭数据库连接时出错: {e}")
+
+    async def close(self):
+        """关闭连接池；之后的 get_connection() 会抛出 RuntimeError，直到再次调用 initialize()。
+        仍被借出的连接在归还时关闭。"""
+        self._closed = True
+        pool = self._pool
+        self._connections = []
+        self._created = 0
+        self._pool = None
+        self._pool_loop = None
+        idle = []
+        if pool is not None:
+            while not pool.empty():
+                idle.append(pool.get_nowait())
+            # 唤醒仍在等待空闲连接的协程，让它们收到 RuntimeError 而不是永远挂起
+            pool.put_nowait(None)
+        await self._close_connections(idle)
 
     async def initialize(self):
-        async with self.get_connection() as db:
+        self._closed = False
+        db = await self._open_connection()
+        try:
             await self.create_users_table(db)
             await self.create_messages_table(db)
             await self.create_blacklist_table(db)
@@ -31,8 +127,11 @@ class DatabaseManager:
             await self.create_filtered_messages_table(db)
             await self.create_knowledge_base_table(db)
             await self.create_exemptions_table(db)
+            await self.create_moderation_verdicts_table(db)
             await self.migrate_database(db)
             await db.commit()
+        finally:
+            await db.close()
         logging.info("数据库初始化完成。")
 
     async def create_users_table(self, db):
@@ -112,15 +211,20 @@ class DatabaseManager:
         await db.execute('CREATE INDEX IF NOT EXISTS idx_admins_active ON admins(is_active)')
 
     async def create_verification_sessions_table(self, db):
+        async with db.execute('PRAGMA table_info(verification_sessions)') as cursor:
+            columns = {row[1] for row in await cursor.fetchall()}
+        if columns and 'kind' not in columns:
+            # 旧版表结构从未被写入过，直接按共享会话存储的结构重建
+            await db.execute('DROP TABLE verification_sessions')
+            logging.info("数据库迁移：重建 'verification_sessions' 表用于共享会话存储。")
         await db.execute('''
             CREATE TABLE IF NOT EXISTS verification_sessions (
-                user_id INTEGER PRIMARY KEY,
-                question TEXT NOT NULL,
-                answer TEXT NOT NULL,
-                attempts INTEGER DEFAULT 0,
+                kind TEXT NOT NULL,
+                user_id INTEGER NOT NULL,
+                data TEXT NOT NULL,
+                expires_at REAL NOT NULL,
                 created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                expires_at TIMESTAMP NOT NULL,
-                FOREIGN KEY (user_id) REFERENCES users(user_id) ON DELETE CASCADE
+                PRIMARY KEY (kind, user_id)
             )
         ''')
         await db.execute('CREATE INDEX IF NOT EXISTS idx_verification_expires ON verification_sessions(expires_at)')
@@ -144,10 +248,12 @@ class DatabaseManager:
             ('ai_provider', 'gemini', '当前使用的AI提供商 (gemini, openai)'),
             
             ('gemini_model_filter', 'gemini-2.5-flash', 'Gemini 内容审查模型'),
+            ('gemini_model_triage', 'gemini-2.5-flash-lite', 'Gemini 快速初审模型'),
             ('gemini_model_verification', 'gemini-2.5-flash-lite', 'Gemini 验证码生成模型'),
             ('gemini_model_autoreply', 'gemini-2.5-flash', 'Gemini 自动回复模型'),
 
             ('openai_model_filter', 'gpt-4.1', 'OpenAI 内容审查模型'),
+            ('openai_model_triage', 'gpt-4.1-mini', 'OpenAI 快速初审模型'),
             ('openai_model_verification', 'gpt-4.1-mini', 'OpenAI 验证码生成模型'),
             ('openai_model_autoreply', 'gpt-4.1', 'OpenAI 自动回复模型')
         ]
@@ -219,6 +325,18 @@ class DatabaseManager:
         await db.execute('CREATE INDEX IF NOT EXISTS idx_exemptions_expires ON exemptions(expires_at)')
         await db.execute('CREATE INDEX IF NOT EXISTS idx_exemptions_permanent ON exemptions(is_permanent)')
 
+    async def create_moderation_verdicts_table(self, db):
+        await db.execute('''
+            CREATE TABLE IF NOT EXISTS moderation_verdicts (
+                cache_key TEXT PRIMARY KEY,
+                is_spam INTEGER NOT NULL,
+                reason TEXT,
+                expires_at REAL NOT NULL,
+                input_budget TEXT
+            )
+        ''')
+        await db.execute('CREATE INDEX IF NOT EXISTS idx_moderation_verdicts_expires ON moderation_verdicts(expires_at)')
+
     async def get_filtered_messages_by_user(self, user_id, limit=5):
         async with self.get_connection() as db:
             cursor = await db.execute(
@@ -229,6 +347,13 @@ class DatabaseManager:
             return [{"content": row[0], "reason": row[1]} for row in rows]
 
     async def migrate_database(self, db):
+        try:
+            await db.execute('ALTER TABLE moderation_verdicts ADD COLUMN input_budget TEXT')
+            logging.info("数据库迁移：成功为 'moderation_verdicts' 表添加 'input_budget' 列。")
+        except aiosqlite.OperationalError as e:
+            if "duplicate column name" not in str(e):
+                raise e
+
         try:
             await db.execute('ALTER TABLE users ADD COLUMN blacklist_strikes INTEGER DEFAULT 0 NOT NULL')
             logging.info("数据库迁移：成功为 'users' 表添加 'blacklist_strikes' 列。")
@@ -277,10 +402,12 @@ class DatabaseManager:
             await db.execute('INSERT OR IGNORE INTO settings (key, value, description) VALUES (?, ?, ?)', ('ai_provider', 'gemini', '当前使用的AI提供商 (gemini, openai)'))
             
             await db.execute('INSERT OR IGNORE INTO settings (key, value, description) VALUES (?, ?, ?)', ('gemini_model_filter', 'gemini-2.5-flash', 'Gemini 内容审查模型'))
+            await db.execute('INSERT OR IGNORE INTO settings (key, value, description) VALUES (?, ?, ?)', ('gemini_model_triage', 'gemini-2.5-flash-lite', 'Gemini 快速初审模型'))
             await db.execute('INSERT OR IGNORE INTO settings (key, value, description) VALUES (?, ?, ?)', ('gemini_model_verification', 'gemini-2.5-flash-lite', 'Gemini 验证码生成模型'))
             await db.execute('INSERT OR IGNORE INTO settings (key, value, description) VALUES (?, ?, ?)', ('gemini_model_autoreply', 'gemini-2.5-flash', 'Gemini 自动回复模型'))
 
             await db.execute('INSERT OR IGNORE INTO settings (key, value, description) VALUES (?, ?, ?)', ('openai_model_filter', 'gpt-4.1', 'OpenAI 内容审查模型'))
+            await db.execute('INSERT OR IGNORE INTO settings (key, value, description) VALUES (?, ?, ?)', ('openai_model_triage', 'gpt-4.1-mini', 'OpenAI 快速初审模型'))
             await db.execute('INSERT OR IGNORE INTO settings (key, value, description) VALUES (?, ?, ?)', ('openai_model_verification', 'gpt-4.1-mini', 'OpenAI 验证码生成模型'))
             await db.execute('INSERT OR IGNORE INTO settings (key, value, description) VALUES (?, ?, ?)', ('openai_model_autoreply', 'gpt-4.1', 'OpenAI 自动回复模型'))
 
@@ -0,0 +1,120 @@
+import math
+import unicodedata
+from utils.text_terms import iter_terms
+from .db_manager import db_manager
+
+def _terms(text: str) -> list:
+    return list(iter_terms(unicodedata.normalize('NFKC', text or '').lower()))
+
+class KnowledgeIndex:
+    """knowledge_base 表的进程内 BM25 倒排索引。
+
+    首次检索时整表加载；之后知识条目的增改删通过 upsert()/remove() 增量更新，
+    无需重建。加载期间发生的修改会使本次加载作废，下次检索时重新加载。
+    """
+
+    K1 = 1.5
+    B = 0.75
+    # 标题中的词按出现两次计算
+    TITLE_WEIGHT = 2
+
+    def __init__(self, manager):
+        self._manager = manager
+        self._entries = {}
+        self._lengths = {}
+        self._postings = {}
+        self._total_length = 0
+        self._version = 0
+        self._loaded_version = None
+        self.queries = 0
+        self.no_match = 0
+
+    @property
+    def version(self) -> int:
+        return self._version
+
+    def _add(self, entry: dict):
+        entry_id = entry['id']
+        frequencies = {}
+        for term in _terms(entry['title']) * self.TITLE_WEIGHT + _terms(entry['content']):
+            frequencies[term] = frequencies.get(term, 0) + 1
+        for term, tf in frequencies.items():
+            self._postings.setdefault(term, {})[entry_id] = tf
+        length = sum(frequencies.values())
+        self._entries[entry_id] = {'id': entry_id, 'title': entry['title'], 'content': entry['content']}
+        self._lengths[entry_id] = length
+        self._total_length += length
+
+    def _discard(self, entry_id: int):
+        entry = self._entries.pop(entry_id, None)
+        if entry is None:
+            return
+        for term in set(_terms(entry['title']) + _terms(entry['content'])):
+            posting = self._postings.get(term)
+            if posting is not None:
+                posting.pop(entry_id, None)
+                if not posting:
+                    del self._postings[term]
+        self._total_length -= self._lengths.pop(entry_id)
+
+    async def _reload(self):
+        version = self._version
+        async with self._manager.get_connection() as db:
+            async with db.execute('SELECT id, title, content FROM knowledge_base') as cursor:
+                rows = await cursor.fetchall()
+        self._entries, self._lengths, self._postings, self._total_length = {}, {}, {}, 0
+        for row in rows:
+            self._add({'id': row[0], 'title': row[1], 'content': row[2]})
+        self._loaded_version = version
+
+    def upsert(self, entry_id: int, title: str, content: str):
+        loaded = self._loaded_version == self._version
+        self._version += 1
+        if loaded:
+            self._discard(entry_id)
+            self._add({'id': entry_id, 'title': title, 'content': content})
+            self._loaded_version = self._version
+
+    def remove(self, entry_id: int):
+        loaded = self._loaded_version == self._version
+        self._version += 1
+        if loaded:
+            self._discard(entry_id)
+            self._loaded_version = self._version
+
+    async def search(self, query: str, top_k: int = 3, min_score: float = 0.0) -> list:
+        """返回得分高于 min_score 的前 top_k 条知识条目（附带 score），按得分降序"""
+        if self._loaded_version != self._version:
+            await self._reload()
+        self.queries += 1
+
+        count = len(self._entries)
+        scores = {}
+        if count:
+            average_length = self._total_length / count or 1
+            for term in set(_terms(query)):
+                posting = self._postings.get(term)
+                if not posting:
+                    continue
+                idf = math.log(1 + (count - len(posting) + 0.5) / (len(posting) + 0.5))
+                for entry_id, tf in posting.items():
+                    norm = 1 - self.B + self.B * self._lengths[entry_id] / average_length
+                    scores[entry_id] = scores.get(entry_id, 0.0) + idf * tf * (self.K1 + 1) / (tf + self.K1 * norm)
+
+        ranked = sorted(
+            ((score, entry_id) for entry_id, score in scores.items() if score > min_score),
+            reverse=True
+        )[:top_k]
+        if not ranked:
+            self.no_match += 1
+        return [{**self._entries[entry_id], 'score': score} for score, entry_id in ranked]
+
+    def stats(self) -> dict:
+        return {
+            "entries": len(self._entries),
+            "terms": len(self._postings),
+            "queries": self.queries,
+            "no_match": self.no_match,
+        }
+
+knowledge_index = KnowledgeIndex(db_manager)
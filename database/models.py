@@ -1,44 +1,118 @@
 from datetime import datetime, timezone, timedelta
 from .db_manager import db_manager
+from .write_queue import write_queue
+from .cache import user_cache
+from .settings_store import settings_store
+from .knowledge_index import knowledge_index
 from config import config
 
+async def _queue_write(table: str, sql: str, params: tuple, wait: bool, user_id: int = None):
+    future = write_queue.submit(table, sql, params)
+    if user_id is not None:
+        user_cache.invalidate(user_id)
+    if wait:
+        await future
+
 async def get_user(user_id: int):
+    cached = user_cache.get('user', user_id)
+    if cached is not user_cache.MISSING:
+        return dict(cached) if cached else None
+
+    epoch = user_cache.epoch
+    await write_queue.sync('users')
     async with db_manager.get_connection() as db:
         async with db.execute(
             'SELECT * FROM users WHERE user_id = ?',
             (user_id,)
         ) as cursor:
             row = await cursor.fetchone()
-            if row:
-                return dict(zip([col[0] for col in cursor.description], row))
-            return None
+            user = dict(zip([col[0] for col in cursor.description], row)) if row else None
+    user_cache.set('user', user_id, user, epoch)
+    return dict(user) if user else None
 
-async def add_user(user_id: int, username: str, first_name: str, last_name: str = None, language_code: str = None):
+async def _load_user_gate_row(user_id: int) -> dict:
+    epoch = user_cache.epoch
+    await write_queue.sync('users', 'blacklist')
     async with db_manager.get_connection() as db:
-        await db.execute('''
-            INSERT OR REPLACE INTO users
-            (user_id, username, first_name, last_name, language_code, last_active)
-            VALUES (?, ?, ?, ?, ?, ?)
-        ''', (user_id, username, first_name, last_name, language_code, datetime.now()))
-        await db.commit()
+        async with db.execute('''
+            SELECT
+                u.user_id IS NOT NULL AS user_exists,
+                COALESCE(u.is_verified, 0) AS is_verified,
+                u.thread_id,
+                u.verification_mode,
+                COALESCE(u.ai_check_disabled, 0) AS ai_check_disabled,
+                b.user_id IS NOT NULL AS is_blacklisted,
+                COALESCE(b.permanent, 0) AS blacklist_permanent,
+                e.user_id IS NOT NULL AS has_exemption,
+                e.is_permanent AS exemption_permanent,
+                e.expires_at AS exemption_expires_at
+            FROM (SELECT ? AS user_id) q
+            LEFT JOIN users u ON u.user_id = q.user_id
+            LEFT JOIN blacklist b ON b.user_id = q.user_id
+            LEFT JOIN exemptions e ON e.user_id = q.user_id
+        ''', (user_id,)) as cursor:
+            row = await cursor.fetchone()
+            data = dict(zip([col[0] for col in cursor.description], row))
+    user_cache.set('gate', user_id, data, epoch)
+    return data
+
+def invalidate_user_cache(user_id: int):
+    """其他进程（如 cloudflare_web）修改了该用户的数据后，丢弃本进程中的缓存"""
+    user_cache.invalidate(user_id)
+
+async def get_user_gate_snapshot(user_id: int) -> dict:
+    """
+    一次查询取出 handle_message 入口检查所需的全部状态：
+    用户是否存在/已验证、验证模式、AI 审查开关、黑名单、豁免以及自动回复开关。
+    """
+    data = user_cache.get('gate', user_id)
+    if data is user_cache.MISSING:
+        data = await _load_user_gate_row(user_id)
+
+    # 豁免是否过期在读取时计算，缓存中只保存原始字段
+    return {
+        'user_exists': bool(data['user_exists']),
+        'is_verified': bool(data['is_verified']),
+        'thread_id': data['thread_id'],
+        'verification_mode': data['verification_mode'],
+        'ai_check_disabled': bool(data['ai_check_disabled']),
+        'is_blacklisted': bool(data['is_blacklisted']),
+        'blacklist_permanent': bool(data['blacklist_permanent']),
+        'is_exempted': bool(data['has_exemption']) and _is_exemption_active(
+            bool(data['exemption_permanent']), data['exemption_expires_at']
+        ),
+        'autoreply_enabled': await get_autoreply_enabled(),
+    }
+
+async def add_user(user_id: int, username: str, first_name: str, last_name: str = None, language_code: str = None, wait: bool = False):
+    await _queue_write('users', '''
+        INSERT OR REPLACE INTO users
+        (user_id, username, first_name, last_name, language_code, last_active)
+        VALUES (?, ?, ?, ?, ?, ?)
+    ''', (user_id, username, first_name, last_name, language_code, datetime.now()), wait, user_id)
 
 async def update_user_verification(user_id: int, is_verified: bool):
+    await write_queue.sync('users')
     async with db_manager.get_connection() as db:
         await db.execute(
             'UPDATE users SET is_verified = ? WHERE user_id = ?',
             (1 if is_verified else 0, user_id)
         )
         await db.commit()
+    user_cache.invalidate(user_id)
 
 async def update_user_thread_id(user_id: int, thread_id: int):
+    await write_queue.sync('users')
     async with db_manager.get_connection() as db:
         await db.execute(
             'UPDATE users SET thread_id = ? WHERE user_id = ?',
             (thread_id, user_id)
         )
         await db.commit()
+    user_cache.invalidate(user_id)
 
 async def get_user_by_thread_id(thread_id: int):
+    await write_queue.sync('users')
     async with db_manager.get_connection() as db:
         async with db.execute(
             'SELECT * FROM users WHERE thread_id = ?',
@@ -49,25 +123,22 @@ async def get_user_by_thread_id(thread_id: int):
                 return dict(zip([col[0] for col in cursor.description], row))
             return None
 
-async def save_message(user_id: int, message_id: int, content: str, direction: str, media_type: str = None, media_file_id: str = None):
-    async with db_manager.get_connection() as db:
-        await db.execute('''
-            INSERT INTO messages
-            (user_id, message_id, content, direction, media_type, media_file_id)
-            VALUES (?, ?, ?, ?, ?, ?)
-        ''', (user_id, message_id, content, direction, media_type, media_file_id))
-        await db.commit()
+async def save_message(user_id: int, message_id: int, content: str, direction: str, media_type: str = None, media_file_id: str = None, wait: bool = False):
+    await _queue_write('messages', '''
+        INSERT INTO messages
+        (user_id, message_id, content, direction, media_type, media_file_id)
+        VALUES (?, ?, ?, ?, ?, ?)
+    ''', (user_id, message_id, content, direction, media_type, media_file_id), wait)
 
-async def save_filtered_message(user_id: int, message_id: int, content: str, reason: str, media_type: str = None, media_file_id: str = None):
-    async with db_manager.get_connection() as db:
-        await db.execute('''
-            INSERT INTO filtered_messages
-            (user_id, message_id, content, reason, media_type, media_file_id)
-            VALUES (?, ?, ?, ?, ?, ?)
-        ''', (user_id, message_id, content, reason, media_type, media_file_id))
-        await db.commit()
+async def save_filtered_message(user_id: int, message_id: int, content: str, reason: str, media_type: str = None, media_file_id: str = None, wait: bool = False):
+    await _queue_write('filtered_messages', '''
+        INSERT INTO filtered_messages
+        (user_id, message_id, content, reason, media_type, media_file_id)
+        VALUES (?, ?, ?, ?, ?, ?)
+    ''', (user_id, message_id, content, reason, media_type, media_file_id), wait)
 
 async def get_filtered_messages(limit: int = 20, offset: int = 0):
+    await write_queue.sync('filtered_messages', 'users')
     async with db_manager.get_connection() as db:
         async with db.execute('''
             SELECT fm.*, u.first_name, u.username
@@ -82,46 +153,77 @@ async def get_filtered_messages(limit: int = 20, offset: int = 0):
             cols = [description[0] for description in cursor.description]
             return [dict(zip(cols, row)) for row in rows]
 
+async def get_filtered_message_texts(limit: int = 5000, exclude_reason_prefix: str = None) -> list:
+    """最近被拦截的文本内容，用于训练本地过滤模型"""
+    await write_queue.sync('filtered_messages')
+    sql = "SELECT content FROM filtered_messages WHERE content IS NOT NULL AND content != ''"
+    params = []
+    if exclude_reason_prefix:
+        sql += " AND (reason IS NULL OR reason NOT LIKE ? || '%')"
+        params.append(exclude_reason_prefix)
+    sql += " ORDER BY id DESC LIMIT ?"
+    params.append(limit)
+    async with db_manager.get_connection() as db:
+        async with db.execute(sql, params) as cursor:
+            rows = await cursor.fetchall()
+            return [row[0] for row in rows]
+
 async def get_filtered_messages_count() -> int:
+    await write_queue.sync('filtered_messages')
     async with db_manager.get_connection() as db:
         async with db.execute('SELECT COUNT(*) FROM filtered_messages') as cursor:
             row = await cursor.fetchone()
             return row[0] if row else 0
 
 async def is_ai_check_disabled(user_id: int) -> bool:
+    cached = user_cache.get('ai_check_disabled', user_id)
+    if cached is not user_cache.MISSING:
+        return cached
+
+    epoch = user_cache.epoch
+    await write_queue.sync('users')
     async with db_manager.get_connection() as db:
         async with db.execute(
             'SELECT ai_check_disabled FROM users WHERE user_id = ?',
             (user_id,)
         ) as cursor:
             row = await cursor.fetchone()
-            if row:
-                return bool(row[0])
-            return False
+            disabled = bool(row[0]) if row else False
+    user_cache.set('ai_check_disabled', user_id, disabled, epoch)
+    return disabled
 
 async def set_ai_check_disabled(user_id: int, disabled: bool):
+    await write_queue.sync('users')
     async with db_manager.get_connection() as db:
         await db.execute(
             'UPDATE users SET ai_check_disabled = ? WHERE user_id = ?',
             (1 if disabled else 0, user_id)
         )
         await db.commit()
+    user_cache.invalidate(user_id)
 
 async def get_user_verification_mode(user_id: int) -> str:
     """获取用户的验证模式偏好 (text/image/None)"""
+    cached = user_cache.get('verification_mode', user_id)
+    if cached is not user_cache.MISSING:
+        return cached
+
+    epoch = user_cache.epoch
+    await write_queue.sync('users')
     async with db_manager.get_connection() as db:
         async with db.execute(
             'SELECT verification_mode FROM users WHERE user_id = ?',
             (user_id,)
         ) as cursor:
             row = await cursor.fetchone()
-            if row:
-                return row[0]  # 可能是 'text', 'image', 或 None
-            return None
+            mode = row[0] if row else None  # 可能是 'text', 'image', 或 None
+    user_cache.set('verification_mode', user_id, mode, epoch)
+    return mode
 
 
 async def get_user_verification_image_type(user_id: int) -> str:
     """获取用户图片验证码类型偏好：'digits', 'letters', 'mixed' 或 None"""
+    await write_queue.sync('users')
     async with db_manager.get_connection() as db:
         async with db.execute(
             'SELECT verification_image_type FROM users WHERE user_id = ?',
@@ -135,6 +237,7 @@ async def get_user_verification_image_type(user_id: int) -> str:
 
 async def set_user_verification_image_type(user_id: int, image_type: str):
     """设置用户图片验证码类型偏好。image_type 可为 'digits', 'letters', 'mixed' 或 None"""
+    await write_queue.sync('users')
     async with db_manager.get_connection() as db:
         # 确保用户存在
         await db.execute(
@@ -146,9 +249,11 @@ async def set_user_verification_image_type(user_id: int, image_type: str):
             (image_type, user_id)
         )
         await db.commit()
+    user_cache.invalidate(user_id)
 
 async def set_user_verification_mode(user_id: int, mode: str):
     """设置用户的验证模式偏好 (text/image/None)"""
+    await write_queue.sync('users')
     async with db_manager.get_connection() as db:
         # 确保用户存在
         await db.execute(
@@ -161,28 +266,27 @@ async def set_user_verification_mode(user_id: int, mode: str):
             (mode, user_id)
         )
         await db.commit()
-
-
-async def add_to_blacklist(user_id: int, reason: str, blocked_by: int, permanent: bool = False):
-    async with db_manager.get_connection() as db:
-        await db.execute(
-            'UPDATE users SET is_blacklisted = 1, blacklist_strikes = blacklist_strikes + 1 WHERE user_id = ?',
-            (user_id,)
-        )
-        await db.execute('''
-            INSERT OR REPLACE INTO blacklist (user_id, reason, blocked_by, permanent)
-            VALUES (?, ?, ?, ?)
-        ''', (user_id, reason, blocked_by, 1 if permanent else 0))
-        await db.commit()
-
-async def remove_from_blacklist(user_id: int):
-    async with db_manager.get_connection() as db:
-        await db.execute(
-            'UPDATE users SET is_blacklisted = 0 WHERE user_id = ?',
-            (user_id,)
-        )
-        await db.execute('DELETE FROM blacklist WHERE user_id = ?', (user_id,))
-        await db.commit()
+    user_cache.invalidate(user_id)
+
+
+async def add_to_blacklist(user_id: int, reason: str, blocked_by: int, permanent: bool = False, wait: bool = False):
+    write_queue.submit(
+        'users',
+        'UPDATE users SET is_blacklisted = 1, blacklist_strikes = blacklist_strikes + 1 WHERE user_id = ?',
+        (user_id,)
+    )
+    await _queue_write('blacklist', '''
+        INSERT OR REPLACE INTO blacklist (user_id, reason, blocked_by, permanent)
+        VALUES (?, ?, ?, ?)
+    ''', (user_id, reason, blocked_by, 1 if permanent else 0), wait, user_id)
+
+async def remove_from_blacklist(user_id: int, wait: bool = False):
+    write_queue.submit(
+        'users',
+        'UPDATE users SET is_blacklisted = 0 WHERE user_id = ?',
+        (user_id,)
+    )
+    await _queue_write('blacklist', 'DELETE FROM blacklist WHERE user_id = ?', (user_id,), wait, user_id)
 
 async def is_blacklisted(user_id: int):
     """
@@ -191,6 +295,12 @@ async def is_blacklisted(user_id: int):
     - is_blocked: 用户是否被黑名单
     - is_permanent: 黑名单是否永久
     """
+    cached = user_cache.get('blacklist', user_id)
+    if cached is not user_cache.MISSING:
+        return cached
+
+    epoch = user_cache.epoch
+    await write_queue.sync('blacklist')
     async with db_manager.get_connection() as db:
         async with db.execute(
             'SELECT permanent FROM blacklist WHERE user_id = ?',
@@ -199,10 +309,14 @@ async def is_blacklisted(user_id: int):
             row = await cursor.fetchone()
             if row:
                 is_permanent = bool(row[0])
-                return (True, is_permanent)
-            return (False, False)
+                result = (True, is_permanent)
+            else:
+                result = (False, False)
+    user_cache.set('blacklist', user_id, result, epoch)
+    return result
 
 async def get_blacklist():
+    await write_queue.sync('blacklist', 'users')
     async with db_manager.get_connection() as db:
         async with db.execute('''
             SELECT b.user_id, u.first_name, u.username, b.reason, b.blocked_at
@@ -217,6 +331,7 @@ async def get_blacklist():
             return [dict(zip(cols, row)) for row in rows]
 
 async def get_blacklist_paginated(limit: int = 5, offset: int = 0):
+    await write_queue.sync('blacklist', 'users')
     async with db_manager.get_connection() as db:
         async with db.execute('''
             SELECT b.user_id, u.first_name, u.username, b.reason, b.blocked_at
@@ -232,45 +347,52 @@ async def get_blacklist_paginated(limit: int = 5, offset: int = 0):
             return [dict(zip(cols, row)) for row in rows]
 
 async def get_blacklist_count() -> int:
+    await write_queue.sync('blacklist')
     async with db_manager.get_connection() as db:
         async with db.execute('SELECT COUNT(*) FROM blacklist') as cursor:
             row = await cursor.fetchone()
             return row[0] if row else 0
 
-async def set_user_blacklist_strikes(user_id: int, strikes: int):
-    async with db_manager.get_connection() as db:
-        await db.execute(
-            'INSERT OR IGNORE INTO users (user_id, first_name) VALUES (?, ?)',
-            (user_id, f"User_{user_id}")
-        )
-        await db.execute(
-            'UPDATE users SET blacklist_strikes = ? WHERE user_id = ?',
-            (strikes, user_id)
-        )
-        await db.commit()
+async def set_user_blacklist_strikes(user_id: int, strikes: int, wait: bool = False):
+    write_queue.submit(
+        'users',
+        'INSERT OR IGNORE INTO users (user_id, first_name) VALUES (?, ?)',
+        (user_id, f"User_{user_id}")
+    )
+    await _queue_write(
+        'users',
+        'UPDATE users SET blacklist_strikes = ? WHERE user_id = ?',
+        (strikes, user_id),
+        wait,
+        user_id
+    )
 
 async def is_admin(user_id: int) -> bool:
     return user_id in config.ADMIN_IDS
 
 async def get_total_users_count() -> int:
+    await write_queue.sync('users')
     async with db_manager.get_connection() as db:
         async with db.execute('SELECT COUNT(*) FROM users') as cursor:
             row = await cursor.fetchone()
             return row[0] if row else 0
 
 async def get_blocked_users_count() -> int:
+    await write_queue.sync('blacklist')
     async with db_manager.get_connection() as db:
         async with db.execute('SELECT COUNT(*) FROM blacklist') as cursor:
             row = await cursor.fetchone()
             return row[0] if row else 0
 
 async def get_user_spam_count(user_id: int) -> int:
+    await write_queue.sync('filtered_messages')
     async with db_manager.get_connection() as db:
         async with db.execute('SELECT COUNT(*) FROM filtered_messages WHERE user_id = ?', (user_id,)) as cursor:
             row = await cursor.fetchone()
             return row[0] if row else 0
 
 async def get_all_users_paginated(limit: int = 5, offset: int = 0):
+    await write_queue.sync('users', 'filtered_messages')
     async with db_manager.get_connection() as db:
         async with db.execute('''
             SELECT 
@@ -295,6 +417,7 @@ async def get_all_users_paginated(limit: int = 5, offset: int = 0):
             return [dict(zip(cols, row)) for row in rows]
 
 async def get_blacklist_user_details(user_id: int):
+    await write_queue.sync('blacklist', 'users', 'filtered_messages')
     async with db_manager.get_connection() as db:
         async with db.execute('''
             SELECT 
@@ -327,11 +450,12 @@ async def get_blacklist_user_details(user_id: int):
 
 async def add_knowledge_entry(title: str, content: str):
     async with db_manager.get_connection() as db:
-        await db.execute('''
+        cursor = await db.execute('''
             INSERT INTO knowledge_base (title, content, updated_at)
             VALUES (?, ?, CURRENT_TIMESTAMP)
         ''', (title, content))
         await db.commit()
+    knowledge_index.upsert(cursor.lastrowid, title, content)
 
 async def get_all_knowledge_entries():
     async with db_manager.get_connection() as db:
@@ -367,11 +491,13 @@ async def update_knowledge_entry(knowledge_id: int, title: str, content: str):
             WHERE id = ?
         ''', (title, content, knowledge_id))
         await db.commit()
+    knowledge_index.upsert(knowledge_id, title, content)
 
 async def delete_knowledge_entry(knowledge_id: int):
     async with db_manager.get_connection() as db:
         await db.execute('DELETE FROM knowledge_base WHERE id = ?', (knowledge_id,))
         await db.commit()
+    knowledge_index.remove(knowledge_id)
 
 async def get_all_knowledge_content() -> str:
     entries = await get_all_knowledge_entries()
@@ -385,54 +511,61 @@ async def get_all_knowledge_content() -> str:
     
     return knowledge_text
 
+async def get_relevant_knowledge_content(query: str) -> str:
+    """只返回与问题最相关的 AUTOREPLY_TOP_K 条知识，格式与 get_all_knowledge_content 相同；没有足够相关的条目时返回空字符串"""
+    entries = await knowledge_index.search(query, config.AUTOREPLY_TOP_K, config.AUTOREPLY_MIN_SCORE)
+    if not entries:
+        return ""
+
+    knowledge_text = "知识库内容：\n\n"
+    for entry in entries:
+        knowledge_text += f"标题：{entry['title']}\n"
+        knowledge_text += f"内容：{entry['content']}\n\n"
+
+    return knowledge_text
+
 async def get_autoreply_enabled() -> bool:
-    async with db_manager.get_connection() as db:
-        async with db.execute(
-            'SELECT value FROM settings WHERE key = ?',
-            ('autoreply_enabled',)
-        ) as cursor:
-            row = await cursor.fetchone()
-            if row:
-                return row[0] == '1'
-            return False
+    return await settings_store.get('autoreply_enabled') == '1'
 
 async def set_autoreply_enabled(enabled: bool):
-    async with db_manager.get_connection() as db:
-        await db.execute(
-            'UPDATE settings SET value = ?, updated_at = CURRENT_TIMESTAMP WHERE key = ?',
-            ('1' if enabled else '0', 'autoreply_enabled')
-        )
-        await db.commit()
+    await settings_store.set('autoreply_enabled', '1' if enabled else '0')
 
-async def is_exempted(user_id: int) -> bool:
-    async with db_manager.get_connection() as db:
-        async with db.execute('''
-            SELECT is_permanent, expires_at 
-            FROM exemptions 
-            WHERE user_id = ?
-        ''', (user_id,)) as cursor:
-            row = await cursor.fetchone()
-            if not row:
-                return False
-            
-            is_permanent = bool(row[0])
-            expires_at = row[1]
-            
-            if is_permanent:
-                return True
-            
-            if expires_at:
-                try:
-                    expires_datetime = datetime.fromisoformat(expires_at.replace('Z', '+00:00'))
-                    if expires_datetime.tzinfo is None:
-                        expires_datetime = expires_datetime.replace(tzinfo=timezone.utc)
-                    now = datetime.now(timezone.utc)
-                    return expires_datetime > now
-                except Exception as e:
-                    print(f"解析豁免过期时间失败: {e}")
-                    return False
-            
+def _is_exemption_active(is_permanent, expires_at) -> bool:
+    if is_permanent:
+        return True
+    
+    if expires_at:
+        try:
+            expires_datetime = datetime.fromisoformat(expires_at.replace('Z', '+00:00'))
+            if expires_datetime.tzinfo is None:
+                expires_datetime = expires_datetime.replace(tzinfo=timezone.utc)
+            now = datetime.now(timezone.utc)
+            return expires_datetime > now
+        except Exception as e:
+            print(f"解析豁免过期时间失败: {e}")
             return False
+    
+    return False
+
+async def is_exempted(user_id: int) -> bool:
+    # 缓存原始的豁免记录，过期与否在读取时判断
+    exemption = user_cache.get('exemption', user_id)
+    if exemption is user_cache.MISSING:
+        epoch = user_cache.epoch
+        async with db_manager.get_connection() as db:
+            async with db.execute('''
+                SELECT is_permanent, expires_at 
+                FROM exemptions 
+                WHERE user_id = ?
+            ''', (user_id,)) as cursor:
+                row = await cursor.fetchone()
+                exemption = (bool(row[0]), row[1]) if row else None
+        user_cache.set('exemption', user_id, exemption, epoch)
+
+    if not exemption:
+        return False
+    
+    return _is_exemption_active(*exemption)
 
 async def add_exemption(user_id: int, is_permanent: bool, exempted_by: int, reason: str = None, expires_at: str = None):
     async with db_manager.get_connection() as db:
@@ -442,11 +575,13 @@ async def add_exemption(user_id: int, is_permanent: bool, exempted_by: int, reas
             VALUES (?, ?, ?, ?, ?, CURRENT_TIMESTAMP)
         ''', (user_id, 1 if is_permanent else 0, expires_at, exempted_by, reason))
         await db.commit()
+    user_cache.invalidate(user_id)
 
 async def remove_exemption(user_id: int):
     async with db_manager.get_connection() as db:
         await db.execute('DELETE FROM exemptions WHERE user_id = ?', (user_id,))
         await db.commit()
+    user_cache.invalidate(user_id)
 
 async def get_exemption(user_id: int):
     async with db_manager.get_connection() as db:
@@ -462,6 +597,7 @@ async def get_exemption(user_id: int):
             return None
 
 async def get_all_exemptions():
+    await write_queue.sync('users')
     async with db_manager.get_connection() as db:
         async with db.execute('''
             SELECT e.user_id, u.first_name, u.username, e.is_permanent, e.expires_at, 
@@ -477,6 +613,7 @@ async def get_all_exemptions():
             return [dict(zip(cols, row)) for row in rows]
 
 async def get_exemptions_paginated(limit: int = 5, offset: int = 0):
+    await write_queue.sync('users')
     async with db_manager.get_connection() as db:
         async with db.execute('''
             SELECT e.user_id, u.first_name, u.username, e.is_permanent, e.expires_at, 
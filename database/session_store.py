@@ -0,0 +1,243 @@
+import heapq
+import json
+import time
+from config import config
+from .db_manager import db_manager
+
+class SessionRecord:
+    """文本、图片、Cloudflare 和解封验证共用的会话记录。
+
+    Cloudflare 验证没有题目和答案，解封验证不计尝试次数，未用到的字段保持默认值。
+    """
+
+    __slots__ = ('answer', 'question', 'options', 'attempts', 'created_at')
+
+    def __init__(self, answer: str = None, question: str = None, options=(), attempts: int = 0,
+                 created_at: float = None):
+        self.answer = answer
+        self.question = question
+        self.options = tuple(options)
+        self.attempts = attempts
+        self.created_at = time.time() if created_at is None else created_at
+
+    @property
+    def expires_at(self) -> float:
+        return self.created_at + config.VERIFICATION_TIMEOUT
+
+    def is_expired(self) -> bool:
+        return time.time() > self.expires_at
+
+    def to_list(self) -> list:
+        return [self.answer, self.question, list(self.options), self.attempts, self.created_at]
+
+    @classmethod
+    def from_list(cls, data: list) -> 'SessionRecord':
+        return cls(*data)
+
+def _encode(value) -> str:
+    if isinstance(value, SessionRecord):
+        value = {'session': value.to_list()}
+    return json.dumps(value, ensure_ascii=False)
+
+def _decode(data: str):
+    value = json.loads(data)
+    if isinstance(value, dict) and 'session' in value:
+        return SessionRecord.from_list(value['session'])
+    return value
+
+class _Kind:
+    __slots__ = ('entries', 'heap')
+
+    def __init__(self):
+        self.entries = {}
+        self.heap = []
+
+class MemorySessionStore:
+    """进程内的会话/计数器存储（默认）。
+
+    按 kind 分组，每个键保存 (值, 过期时间)，过期时间为 time.time() 时间戳。每组另有一个按过期时间
+    排列的最小堆，每次写入时从堆顶顺带清理最多 SWEEP_PER_WRITE 个已过期的条目（读取统计时全部清理），
+    被放弃的会话不会一直留在内存中，长时间空闲后的第一次写入也不会一次清理全部积压。
+    已过期但尚未清理的条目对读取不可见。
+    每组条目数超过 max_entries 时淘汰最先过期的条目，注册洪水期间内存也有上限。
+    值直接以对象保存，调用方不要修改 get() 返回的值，需要修改时使用 update()。
+    """
+
+    name = 'memory'
+    # 每次写入最多弹出的过期堆项数；大于 1，积压的过期条目随写入逐渐清完
+    SWEEP_PER_WRITE = 8
+
+    def __init__(self, max_entries: int = 50000):
+        self.max_entries = max_entries
+        self._kinds = {}
+        self.expired = 0
+        self.evicted = 0
+
+    def _kind(self, kind: str) -> _Kind:
+        group = self._kinds.get(kind)
+        if group is None:
+            group = self._kinds[kind] = _Kind()
+        return group
+
+    def _pop_head(self, group: _Kind) -> bool:
+        """弹出堆顶；堆顶仍是当前条目时一并删除该条目并返回 True，已被覆盖或删除的旧堆项直接丢弃"""
+        expires_at, key = heapq.heappop(group.heap)
+        entry = group.entries.get(key)
+        if entry is not None and entry[1] == expires_at:
+            del group.entries[key]
+            return True
+        return False
+
+    def sweep(self, now: float = None, limit: int = None):
+        """清理所有组中已过期的条目；给出 limit 时最多弹出 limit 个堆项"""
+        now = time.time() if now is None else now
+        for group in self._kinds.values():
+            heap = group.heap
+            while heap and heap[0][0] <= now:
+                if limit is not None:
+                    if limit <= 0:
+                        return
+                    limit -= 1
+                if self._pop_head(group):
+                    self.expired += 1
+
+    def _live(self, group: _Kind, key, now: float):
+        entry = group.entries.get(key)
+        if entry is None or entry[1] <= now:
+            return None
+        return entry[0]
+
+    def _put(self, group: _Kind, key, value, expires_at: float, now: float):
+        self.sweep(now, self.SWEEP_PER_WRITE)
+        if value is None or expires_at <= now:
+            group.entries.pop(key, None)
+            return
+        group.entries[key] = (value, expires_at)
+        heapq.heappush(group.heap, (expires_at, key))
+        while len(group.entries) > self.max_entries:
+            expired = group.heap[0][0] <= now
+            if self._pop_head(group):
+                # 堆顶可能是尚未清理的过期条目
+                if expired:
+                    self.expired += 1
+                else:
+                    self.evicted += 1
+        # 频繁更新的键（如限流计数）会在堆中留下大量旧堆项，超过条目数两倍时重建
+        if len(group.heap) > 2 * len(group.entries) + 64:
+            group.heap = [(entry[1], key) for key, entry in group.entries.items()]
+            heapq.heapify(group.heap)
+
+    async def get(self, kind: str, key):
+        return self._live(self._kind(kind), key, time.time())
+
+    async def set(self, kind: str, key, value, expires_at: float):
+        self._put(self._kind(kind), key, value, expires_at, time.time())
+
+    async def delete(self, kind: str, key):
+        # 堆中留下的旧堆项在到期或重建时丢弃
+        self._kind(kind).entries.pop(key, None)
+
+    async def update(self, kind: str, key, func):
+        """原子地读取-修改-写回。func(当前值或 None) 返回 (新值或 None, 过期时间, 结果)，新值为 None 时删除；返回结果"""
+        now = time.time()
+        group = self._kind(kind)
+        value, expires_at, result = func(self._live(group, key, now))
+        self._put(group, key, value, expires_at, now)
+        return result
+
+    def stats(self) -> dict:
+        self.sweep()
+        return {
+            "backend": self.name,
+            "entries": {kind: len(group.entries) for kind, group in self._kinds.items()},
+            "expired": self.expired,
+            "evicted": self.evicted,
+        }
+
+class SqliteSessionStore:
+    """基于 verification_sessions 表的共享存储。
+
+    同一个数据库文件的所有进程（Bot 与 cloudflare_web）看到同一份会话和计数器，重启后仍然保留。
+    每次写入立即提交（不经过写后队列），update() 在 BEGIN IMMEDIATE 事务中完成读取-修改-写回，
+    多个进程并发修改同一个键时不会丢失更新。已过期的行按 expires_at 索引定期批量删除。
+    """
+
+    name = 'sqlite'
+    # 两次批量删除过期行之间的最短间隔（秒）
+    PURGE_INTERVAL = 60
+
+    def __init__(self, manager):
+        self._manager = manager
+        self._last_purge = 0.0
+        self._counts = {}
+        self.expired = 0
+
+    async def get(self, kind: str, key):
+        async with self._manager.get_connection() as db:
+            async with db.execute(
+                'SELECT data FROM verification_sessions WHERE kind = ? AND user_id = ? AND expires_at > ?',
+                (kind, key, time.time())
+            ) as cursor:
+                row = await cursor.fetchone()
+        return _decode(row[0]) if row else None
+
+    async def _write(self, db, kind: str, key, value, expires_at: float, now: float):
+        if value is None or expires_at <= now:
+            await db.execute('DELETE FROM verification_sessions WHERE kind = ? AND user_id = ?', (kind, key))
+        else:
+            await db.execute(
+                'INSERT OR REPLACE INTO verification_sessions (kind, user_id, data, expires_at) VALUES (?, ?, ?, ?)',
+                (kind, key, _encode(value), expires_at)
+            )
+
+    async def _maybe_purge(self, db, now: float):
+        if now - self._last_purge < self.PURGE_INTERVAL:
+            return
+        self._last_purge = now
+        async with db.execute('DELETE FROM verification_sessions WHERE expires_at <= ?', (now,)) as cursor:
+            self.expired += cursor.rowcount
+        await db.commit()
+        async with db.execute('SELECT kind, COUNT(*) FROM verification_sessions GROUP BY kind') as cursor:
+            self._counts = {row[0]: row[1] for row in await cursor.fetchall()}
+
+    async def set(self, kind: str, key, value, expires_at: float):
+        now = time.time()
+        async with self._manager.get_connection() as db:
+            await self._write(db, kind, key, value, expires_at, now)
+            await db.commit()
+            await self._maybe_purge(db, now)
+
+    async def delete(self, kind: str, key):
+        async with self._manager.get_connection() as db:
+            await db.execute('DELETE FROM verification_sessions WHERE kind = ? AND user_id = ?', (kind, key))
+            await db.commit()
+
+    async def update(self, kind: str, key, func):
+        """原子地读取-修改-写回。func(当前值或 None) 返回 (新值或 None, 过期时间, 结果)，新值为 None 时删除；返回结果"""
+        now = time.time()
+        async with self._manager.get_connection() as db:
+            # 先拿写锁再读取，其他进程的并发修改会等待本事务提交
+            await db.execute('BEGIN IMMEDIATE')
+            async with db.execute(
+                'SELECT data FROM verification_sessions WHERE kind = ? AND user_id = ? AND expires_at > ?',
+                (kind, key, now)
+            ) as cursor:
+                row = await cursor.fetchone()
+            value, expires_at, result = func(_decode(row[0]) if row else None)
+            await self._write(db, kind, key, value, expires_at, now)
+            await db.commit()
+            await self._maybe_purge(db, now)
+        return result
+
+    def stats(self) -> dict:
+        # 共享存储的条目数在定期清理时统计，包含其他进程写入的会话
+        return {"backend": self.name, "entries": dict(self._counts), "expired": self.expired, "evicted": 0}
+
+def _create_store(backend: str):
+    if backend == 'sqlite':
+        return SqliteSessionStore(db_manager)
+    if backend != 'memory':
+        print(f"未知的 STATE_BACKEND: {backend}，使用进程内存储")
+    return MemorySessionStore(config.SESSION_STORE_MAX_ENTRIES)
+
+session_store = _create_store(config.STATE_BACKEND)
@@ -0,0 +1,50 @@
+from .db_manager import db_manager
+
+class SettingsStore:
+    """settings 表的进程内副本。
+
+    首次读取时整表加载，之后直接从内存返回；只有版本号变化（bump()）后
+    才会重新加载。通过 set() 写入的设置会自动递增版本号。
+    """
+
+    def __init__(self, manager):
+        self._manager = manager
+        self._values = {}
+        self._version = 0
+        self._loaded_version = None
+
+    @property
+    def version(self) -> int:
+        return self._version
+
+    def bump(self):
+        self._version += 1
+
+    async def _reload(self):
+        version = self._version
+        async with self._manager.get_connection() as db:
+            async with db.execute('SELECT key, value FROM settings') as cursor:
+                rows = await cursor.fetchall()
+        self._values = {row[0]: row[1] for row in rows}
+        self._loaded_version = version
+
+    async def get(self, key: str, default: str = None) -> str:
+        if self._loaded_version != self._version:
+            await self._reload()
+        return self._values.get(key, default)
+
+    async def get_many(self, keys) -> dict:
+        if self._loaded_version != self._version:
+            await self._reload()
+        return {key: self._values[key] for key in keys if key in self._values}
+
+    async def set(self, key: str, value: str):
+        async with self._manager.get_connection() as db:
+            await db.execute(
+                'UPDATE settings SET value = ?, updated_at = CURRENT_TIMESTAMP WHERE key = ?',
+                (value, key)
+            )
+            await db.commit()
+        self.bump()
+
+settings_store = SettingsStore(db_manager)
@@ -0,0 +1,141 @@
+import asyncio
+import logging
+from itertools import groupby
+from config import config
+from .db_manager import db_manager
+
+class WriteBehindQueue:
+    """写后队列：把高频的单条写入攒成批次，在同一个事务里提交（group commit）。
+
+    submit() 立即返回一个 Future，调用方只有在需要确认落盘时才 await 它。
+    读取同一张表之前调用 sync()，保证能读到自己刚写入的数据。
+    """
+
+    def __init__(self, manager, max_batch: int = 200, flush_interval: float = 0.05):
+        self._manager = manager
+        self.max_batch = max_batch
+        self.flush_interval = flush_interval
+        self._pending = []
+        self._dirty_tables = set()
+        self._inflight_tables = set()
+        self._timer = None
+        self._flush_lock = None
+        self._loop = None
+        self._flush_tasks = set()
+
+    def _bind_loop(self):
+        loop = asyncio.get_running_loop()
+        if self._loop is not loop:
+            self._loop = loop
+            self._flush_lock = asyncio.Lock()
+            self._timer = None
+        return loop
+
+    def submit(self, table: str, sql: str, params: tuple = ()) -> asyncio.Future:
+        loop = self._bind_loop()
+        future = loop.create_future()
+        # 未被 await 的写入失败已记录日志，这里避免 "exception was never retrieved" 警告
+        future.add_done_callback(lambda f: f.cancelled() or f.exception())
+        self._pending.append((sql, params, future))
+        self._dirty_tables.add(table)
+
+        if len(self._pending) >= self.max_batch:
+            self._cancel_timer()
+            self._spawn_flush(loop)
+        elif self._timer is None:
+            self._timer = loop.call_later(self.flush_interval, self._on_timer)
+        return future
+
+    def _on_timer(self):
+        self._timer = None
+        self._spawn_flush(asyncio.get_running_loop())
+
+    def _spawn_flush(self, loop):
+        task = loop.create_task(self.flush())
+        self._flush_tasks.add(task)
+        task.add_done_callback(self._flush_tasks.discard)
+
+    def _cancel_timer(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+
+    @property
+    def pending_count(self) -> int:
+        return len(self._pending)
+
+    async def sync(self, *tables: str):
+        """如果给定表上有尚未提交的写入，则立即刷新。"""
+        dirty = self._dirty_tables | self._inflight_tables
+        if dirty and (not tables or dirty.intersection(tables)):
+            await self.flush()
+
+    async def flush(self):
+        if not self._pending and not self._inflight_tables:
+            return
+        self._bind_loop()
+        async with self._flush_lock:
+            # 串行刷新，保证各批次按提交顺序落盘；正在提交的批次完成后才会轮到这里
+            self._cancel_timer()
+            batch, self._pending = self._pending, []
+            self._inflight_tables, self._dirty_tables = self._dirty_tables, set()
+            try:
+                if batch:
+                    await self._commit_batch(batch)
+            finally:
+                self._inflight_tables = set()
+
+    async def _commit_batch(self, batch):
+        try:
+            async with self._manager.get_connection() as db:
+                try:
+                    # 连续的相同语句合并为 executemany
+                    for sql, group in groupby(batch, key=lambda item: item[0]):
+                        await db.executemany(sql, [params for _, params, _ in group])
+                    await db.commit()
+                except Exception as e:
+                    await db.rollback()
+                    logging.warning(f"批量写入失败，回退为逐条提交: {e}")
+                    await self._commit_one_by_one(db, batch)
+                    return
+        except Exception as e:
+            # 拿不到连接（连接池已关闭、数据库被锁或不可用）等情况：这批写入已移出队列，
+            # 必须让等待结果的调用方收到异常，否则 wait=True 的调用会一直挂起
+            self._drop_batch(batch, e)
+            return
+
+        for _, _, future in batch:
+            if not future.done():
+                future.set_result(None)
+
+    @staticmethod
+    def _drop_batch(batch, error: Exception):
+        dropped = [(sql, future) for sql, _, future in batch if not future.done()]
+        logging.error(f"批量写入失败，丢弃 {len(dropped)} 条写入: {error!r}")
+        for sql, future in dropped:
+            logging.error(f"丢弃的写入 | SQL: {sql.strip()}")
+            future.set_exception(error)
+
+    async def _commit_one_by_one(self, db, batch):
+        for sql, params, future in batch:
+            try:
+                await db.execute(sql, params)
+                await db.commit()
+            except Exception as e:
+                await db.rollback()
+                logging.error(f"写入失败: {e} | SQL: {sql.strip()}")
+                if not future.done():
+                    future.set_exception(e)
+                continue
+            if not future.done():
+                future.set_result(None)
+
+    async def close(self):
+        self._cancel_timer()
+        await self.flush()
+
+write_queue = WriteBehindQueue(
+    db_manager,
+    max_batch=config.DB_WRITE_BATCH_SIZE,
+    flush_interval=config.DB_WRITE_FLUSH_INTERVAL_MS / 1000
+)
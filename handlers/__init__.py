@@ -2,7 +2,7 @@ from telegram.ext import Application, CommandHandler, MessageHandler, CallbackQu
 from .command_handler import start, help_command, panel, ban_user, unban_user
 from .user_handler import handle_message
 from .callback_handler import handle_callback
-from .admin_handler import handle_admin_reply
+from .admin_handler import handle_admin_reply, handle_topic_status
 from config import config
 
 def register_handlers(app: Application):
@@ -13,6 +13,11 @@ def register_handlers(app: Application):
 
     if config.FORUM_GROUP_ID and config.ADMIN_IDS:
         app.add_handler(CommandHandler("panel", panel))
+        app.add_handler(MessageHandler(
+            filters.Chat(chat_id=config.FORUM_GROUP_ID) &
+            (filters.StatusUpdate.FORUM_TOPIC_CLOSED | filters.StatusUpdate.FORUM_TOPIC_REOPENED),
+            handle_topic_status
+        ))
         app.add_handler(MessageHandler(
             filters.Chat(chat_id=config.FORUM_GROUP_ID) & filters.REPLY & ~filters.COMMAND,
             handle_admin_reply
@@ -22,7 +27,9 @@ def register_handlers(app: Application):
             (filters.TEXT | filters.PHOTO | filters.VIDEO | filters.AUDIO | filters.VOICE |
              filters.Document.ALL | filters.Sticker.ALL | filters.ANIMATION) &
             ~filters.COMMAND & filters.ChatType.PRIVATE,
-            handle_message
+            # 不阻塞后续更新：转发等待群组限速时不影响管理员回复和其他用户，同一用户的消息在处理函数内保持顺序
+            handle_message,
+            block=False
         ))
         
         app.add_handler(CallbackQueryHandler(handle_callback))
@@ -2,9 +2,11 @@ from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
 from telegram.ext import ContextTypes
 from database import models as db
 from utils.message_sender import send_message_by_type
+from services.topic_state import topic_state
+from services.outbound import LANE_ADMIN
 
 async def _send_reply_to_user(update: Update, context: ContextTypes.DEFAULT_TYPE, user_id: int):
-    await send_message_by_type(context.bot, update.message, user_id, None, True)
+    await send_message_by_type(context.bot, update.message, user_id, None, True, lane=LANE_ADMIN)
 
 async def handle_admin_reply(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if not update.message or not update.message.is_topic_message:
@@ -20,6 +22,16 @@ async def handle_admin_reply(update: Update, context: ContextTypes.DEFAULT_TYPE)
     
     await _send_reply_to_user(update, context, user_id)
 
+async def handle_topic_status(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """话题被关闭/重新打开时更新话题状态，用户下次发消息时据此决定是否需要重新验证"""
+    message = update.message
+    if not message or not message.message_thread_id:
+        return
+    if message.forum_topic_closed:
+        topic_state.mark_invalid(message.message_thread_id)
+    elif message.forum_topic_reopened:
+        topic_state.mark_valid(message.message_thread_id)
+
 async def _format_filtered_messages(messages, page: int, total_pages: int):
     response = f"被过滤的消息 (第 {page}/{total_pages} 页):\n\n"
     
@@ -1,12 +1,29 @@
+import asyncio
 import re
 import secrets
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, InputMediaPhoto
 from telegram.error import BadRequest
 from telegram.ext import ContextTypes
 from services.verification import verify_answer, create_verification, verify_image_answer, create_image_verification, verify_cloudflare_token
+from services.verification import KIND_TEXT, KIND_IMAGE, KIND_CLOUDFLARE
+from services.blacklist import KIND_UNBLOCK
 from services.gemini_service import gemini_service
 from database import models as db
-from utils.media_converter import sticker_to_image
+from database.cache import user_cache
+from database.settings_store import settings_store
+from database.knowledge_index import knowledge_index
+from database.session_store import session_store
+from services.verdict_cache import verdict_cache
+from services.answer_cache import answer_cache
+from services.local_filter import local_filter
+from services.metrics import metrics
+from services.provider_gateway import provider_gateway
+from services.challenge_pool import challenge_pool
+from services.captcha_engine import captcha_engine
+from services.topic_state import topic_state, is_invalid_topic_error
+from services.outbound import outbound
+from services.rate_limiter import rate_limiter
+from utils.media_converter import get_media_unique_id, load_message_image, media_bytes_cache
 from services.thread_manager import get_or_create_thread
 from .user_handler import _resend_message
 from config import config
@@ -16,6 +33,11 @@ from rss import enable_feature as rss_enable_feature, disable_feature as rss_dis
 RSS_PANEL_CACHE_KEY = "rss_panel_cache"
 RSS_FEEDS_PER_PAGE = 4
 RSS_DOC_URL = "https://github.com/milangree/Antimessage#-rss-%E8%AE%A2%E9%98%85%E5%8A%9F%E8%83%BD"
+AI_SETTING_KEYS = (
+    'ai_provider',
+    'gemini_model_filter', 'gemini_model_triage', 'gemini_model_verification', 'gemini_model_autoreply',
+    'openai_model_filter', 'openai_model_triage', 'openai_model_verification', 'openai_model_autoreply',
+)
 
 
 async def _build_main_panel_keyboard():
@@ -25,6 +47,7 @@ async def _build_main_panel_keyboard():
         [InlineKeyboardButton("被过滤消息", callback_data="panel_filtered_page_1"), InlineKeyboardButton("自动回复管理", callback_data="panel_autoreply")],
         [InlineKeyboardButton("豁免名单管理", callback_data="panel_exemptions_page_1"), InlineKeyboardButton("RSS 功能管理", callback_data="panel_rss")],
         [InlineKeyboardButton("🎯 验证模式", callback_data="cmd_verification_mode"), InlineKeyboardButton("AI 模型设置", callback_data="panel_ai_settings")],
+        [InlineKeyboardButton("📊 运行指标", callback_data="panel_metrics")],
         [InlineKeyboardButton("🔙 返回管理员菜单", callback_data="menu_admin"), InlineKeyboardButton("🏠 返回主菜单", callback_data="menu_start")],
     ]
     return InlineKeyboardMarkup(keyboard)
@@ -219,6 +242,152 @@ def _build_rss_feed_detail(application, chat_id: str, feed_url: str):
 
     return "\n".join(lines), InlineKeyboardMarkup(keyboard_rows)
 
+def _build_metrics_view():
+    cache_stats = user_cache.stats()
+    lines = [
+        "📊 运行指标",
+        "",
+        "用户状态缓存:",
+        f"• 缓存用户数: {cache_stats['users']}",
+        f"• 命中/未命中: {cache_stats['hits']}/{cache_stats['misses']}",
+        f"• 命中率: {cache_stats['hit_rate']:.1%}",
+    ]
+
+    verdict_stats = verdict_cache.stats()
+    lines += [
+        "",
+        "审查结果缓存:",
+        f"• 缓存条目: {verdict_stats['entries']}",
+        f"• 内存命中/持久化命中/未命中: {verdict_stats['hits']}/{verdict_stats['persisted_hits']}/{verdict_stats['misses']}",
+        f"• 命中率: {verdict_stats['hit_rate']:.1%}",
+    ]
+
+    media_stats = media_bytes_cache.stats()
+    lines += [
+        "",
+        "图片缓存:",
+        f"• 缓存图片: {media_stats['entries']} ({media_stats['bytes'] / 1024 / 1024:.1f} MB)",
+        f"• 命中/未命中: {media_stats['hits']}/{media_stats['misses']}",
+        f"• 命中率: {media_stats['hit_rate']:.1%}",
+        f"• 下载/处理后送审: {metrics.count('media.downloaded_bytes') / 1024 / 1024:.1f}/{metrics.count('media.prepared_bytes') / 1024 / 1024:.1f} MB",
+    ]
+
+    triage = metrics.histogram('moderation.triage')
+    heavy = metrics.histogram('moderation.filter')
+    lines += [
+        "",
+        f"分级审查 (置信度阈值 {config.AI_CONFIDENCE_THRESHOLD}):",
+        f"• 初审直接采用/升级复核: {metrics.count('moderation.triage_accepted')}/{metrics.count('moderation.escalated')}",
+        f"• 初审耗时 p50/p95: {triage.percentile(0.5):.0f}/{triage.percentile(0.95):.0f} ms (共 {triage.count} 次)",
+        f"• 复核耗时 p50/p95: {heavy.percentile(0.5):.0f}/{heavy.percentile(0.95):.0f} ms (共 {heavy.count} 次)",
+        f"• 批量请求/合并条数/回退逐条: {metrics.count('moderation.batches')}/{metrics.count('moderation.batched_items')}/{metrics.count('moderation.batch_fallbacks')}",
+        f"• 超长/重复文本裁剪后送审: {metrics.count('moderation.budgeted')}",
+    ]
+
+    gateway_stats = provider_gateway.stats()
+    breakers = ", ".join(f"{name}={state}" for name, state in gateway_stats['breakers'].items()) or "无"
+    queue_wait = metrics.histogram('gateway.queue_wait')
+    lines += [
+        "",
+        f"AI 调用网关 (并发上限 {provider_gateway.max_concurrency}):",
+        f"• 进行中/排队中: {gateway_stats['in_flight']}/{gateway_stats['waiting']}",
+        f"• 熔断器: {breakers}",
+        f"• 调用超时/排队超时/错误/熔断拒绝: {metrics.count('gateway.timeouts')}/{metrics.count('gateway.queue_timeouts')}/{metrics.count('gateway.errors')}/{metrics.count('gateway.rejected')}",
+        f"• 排队耗时 p95: {queue_wait.percentile(0.95):.0f} ms，降级审查: {metrics.count('moderation.degraded')}",
+    ]
+
+    hedge_fired = metrics.count('hedge.fired')
+    lines += ["", f"对冲请求 ({'已启用' if config.AI_HEDGE_ENABLED else '未启用'}，共触发 {hedge_fired} 次):"]
+    for name in ('gemini', 'openai'):
+        latency = metrics.histogram(f'moderation.provider.{name}')
+        wins = metrics.count(f'hedge.win.{name}')
+        win_rate = wins / hedge_fired if hedge_fired else 0.0
+        lines.append(
+            f"• {name}: 胜出 {wins} 次 ({win_rate:.0%})，审查耗时 p50/p95 "
+            f"{latency.percentile(0.5):.0f}/{latency.percentile(0.95):.0f} ms (共 {latency.count} 次)"
+        )
+
+    pool_stats = challenge_pool.stats()
+    lines += [
+        "",
+        "验证问题池:",
+        f"• 可用/池容量: {pool_stats['available']}/{challenge_pool.size}",
+        f"• 池中取用/本地题库: {pool_stats['served']}/{pool_stats['fallbacks']}",
+        f"• 已生成/丢弃: {pool_stats['generated']}/{pool_stats['rejected']}",
+    ]
+
+    captcha_stats = captcha_engine.stats()
+    ready = captcha_stats['ready']
+    lines += [
+        "",
+        "图片验证码:",
+        f"• 预渲染 数字/字母/混合: {ready['digits']}/{ready['letters']}/{ready['mixed']} (每类 {captcha_engine.ring_size})",
+        f"• 预渲染取用/现场渲染: {captcha_stats['served']}/{captcha_stats['rendered_on_demand']}",
+    ]
+
+    session_stats = session_store.stats()
+    live = session_stats['entries']
+    lines += [
+        "",
+        f"验证会话 ({session_stats['backend']}):",
+        f"• 进行中 文本/图片/Cloudflare/解封: {live.get(KIND_TEXT, 0)}/{live.get(KIND_IMAGE, 0)}/{live.get(KIND_CLOUDFLARE, 0)}/{live.get(KIND_UNBLOCK, 0)}",
+        f"• 过期清理/超出上限淘汰: {session_stats['expired']}/{session_stats['evicted']}",
+    ]
+
+    outbound_stats = outbound.stats()
+    sent = outbound_stats['sent']
+    user_wait = metrics.histogram('outbound.user')
+    lines += [
+        "",
+        f"发送限速 (全局每秒 {outbound.global_rate:g} 条):",
+        f"• 已发送 管理员/用户转发/RSS: {sent['admin']}/{sent['user']}/{sent['rss']}",
+        f"• 等待发送: {outbound_stats['waiting']}，用户转发（含排队）p95: {user_wait.percentile(0.95):.0f} ms",
+        f"• 触发限流: {outbound_stats['retry_after']} 次，剩余暂停: {outbound_stats['paused']:.0f} 秒",
+        f"• 用户消息限流跟踪中的用户: {rate_limiter.stats()['tracked_users']}",
+    ]
+
+    topic_stats = topic_state.stats()
+    lines += [
+        "",
+        "话题状态:",
+        f"• 已知可用/已失效: {topic_stats['valid']}/{topic_stats['invalid']}",
+        f"• 标记失效/发送时发现失效: {topic_stats['invalidations']}/{topic_stats['recoveries']}",
+    ]
+
+    knowledge_stats = knowledge_index.stats()
+    lines += [
+        "",
+        "知识库检索:",
+        f"• 条目/词项: {knowledge_stats['entries']}/{knowledge_stats['terms']}",
+        f"• 检索次数: {knowledge_stats['queries']}，无相关条目（跳过 AI）: {knowledge_stats['no_match']}",
+    ]
+
+    answer_stats = answer_cache.stats()
+    lines += [
+        "",
+        "自动回复缓存:",
+        f"• 缓存答案: {answer_stats['entries']}",
+        f"• 命中/未命中: {answer_stats['hits']}/{answer_stats['misses']}",
+        f"• 命中率: {answer_stats['hit_rate']:.1%}",
+    ]
+
+    local_stats = local_filter.stats()
+    lines += [
+        "",
+        "本地预过滤:",
+        f"• 关键词/域名拦截: {local_stats['keyword']}/{local_stats['domain']}",
+        f"• 贝叶斯判定垃圾/正常: {local_stats['bayes_spam']}/{local_stats['bayes_ham']}",
+        f"• 交给 AI 审查: {local_stats['passed']}",
+        f"• 训练样本 垃圾/正常: {local_stats['spam_samples']}/{local_stats['ham_samples']}",
+    ]
+
+    keyboard = [
+        [InlineKeyboardButton("🔄 刷新", callback_data="panel_metrics")],
+        [InlineKeyboardButton("返回主面板", callback_data="panel_back")],
+    ]
+    return "\n".join(lines), InlineKeyboardMarkup(keyboard)
+
+
 async def handle_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer()
@@ -632,15 +801,7 @@ async def handle_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
             if 'pending_update' in context.user_data:
                 pending_update = context.user_data.pop('pending_update')
                 message = pending_update.message
-                image_bytes = None
-
-                if message.photo:
-                    photo_file = await message.photo[-1].get_file()
-                    image_bytes = await photo_file.download_as_bytearray()
-                elif message.sticker and not message.sticker.is_animated and not message.sticker.is_video:
-                    sticker_file = await message.sticker.get_file()
-                    sticker_bytes = await sticker_file.download_as_bytearray()
-                    image_bytes = await sticker_to_image(sticker_bytes)
+                media_id = get_media_unique_id(message)
 
                 should_forward = True
                 if message.video or message.animation:
@@ -655,7 +816,13 @@ async def handle_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
                             text="正在通过AI分析内容是否包含垃圾信息...",
                             reply_to_message_id=message.message_id
                         )
-                        analysis_result = await gemini_service.analyze_message(message, image_bytes)
+                        try:
+                            analysis_result = await gemini_service.analyze_message(
+                                message, media_id=media_id, load_image=lambda: load_message_image(message)
+                            )
+                        except asyncio.TimeoutError:
+                            print("AI analysis timeout")
+                            analysis_result = {"is_spam": False}
                         if analysis_result.get("is_spam"):
                             should_forward = False
                             media_type = None
@@ -688,9 +855,12 @@ async def handle_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
                     try:
                         if not is_new:
-                            await _resend_message(pending_update, context, thread_id)
+                            sent_msg = await _resend_message(pending_update, context, thread_id)
+                            # 误投到其他话题时标记失效，用户下一条消息会触发重新验证
+                            topic_state.record_send(thread_id, sent_msg)
                     except BadRequest as e:
-                        if "Message thread not found" in e.message:
+                        if is_invalid_topic_error(e.message):
+                            topic_state.record_failure(thread_id)
                             await db.update_user_thread_id(user_id, None)
                             await db.update_user_verification(user_id, False)
 
@@ -734,15 +904,7 @@ async def handle_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
             if 'pending_update' in context.user_data:
                 pending_update = context.user_data.pop('pending_update')
                 message = pending_update.message
-                image_bytes = None
-
-                if message.photo:
-                    photo_file = await message.photo[-1].get_file()
-                    image_bytes = await photo_file.download_as_bytearray()
-                elif message.sticker and not message.sticker.is_animated and not message.sticker.is_video:
-                    sticker_file = await message.sticker.get_file()
-                    sticker_bytes = await sticker_file.download_as_bytearray()
-                    image_bytes = await sticker_to_image(sticker_bytes)
+                media_id = get_media_unique_id(message)
 
                 should_forward = True
                 if message.video or message.animation:
@@ -757,7 +919,13 @@ async def handle_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
                             text="正在通过AI分析内容是否包含垃圾信息...",
                             reply_to_message_id=message.message_id
                         )
-                        analysis_result = await gemini_service.analyze_message(message, image_bytes)
+                        try:
+                            analysis_result = await gemini_service.analyze_message(
+                                message, media_id=media_id, load_image=lambda: load_message_image(message)
+                            )
+                        except asyncio.TimeoutError:
+                            print("AI analysis timeout")
+                            analysis_result = {"is_spam": False}
                         if analysis_result.get("is_spam"):
                             should_forward = False
                             media_type = None
@@ -790,9 +958,12 @@ async def handle_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
                     
                     try:
                         if not is_new:
-                            await _resend_message(pending_update, context, thread_id)
+                            sent_msg = await _resend_message(pending_update, context, thread_id)
+                            # 误投到其他话题时标记失效，用户下一条消息会触发重新验证
+                            topic_state.record_send(thread_id, sent_msg)
                     except BadRequest as e:
-                        if "Message thread not found" in e.message:
+                        if is_invalid_topic_error(e.message):
+                            topic_state.record_failure(thread_id)
                             await db.update_user_thread_id(user_id, None)
                             await db.update_user_verification(user_id, False)
                             
@@ -1048,6 +1219,18 @@ async def handle_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
             parse_mode='Markdown'
         )
     
+    elif data == "panel_metrics":
+        if not await db.is_admin(user_id):
+            await query.answer("抱歉，您没有权限执行此操作。", show_alert=True)
+            return
+
+        message, keyboard = _build_metrics_view()
+        try:
+            await query.edit_message_text(message, reply_markup=keyboard)
+        except BadRequest:
+            # 指标未变化时 Telegram 会拒绝相同内容的编辑
+            pass
+
     elif data == "panel_rss":
         if not await db.is_admin(user_id):
             await query.answer("抱歉，您没有权限执行此操作。", show_alert=True)
@@ -1061,16 +1244,7 @@ async def handle_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
             await query.answer("抱歉，您没有权限执行此操作。", show_alert=True)
             return
             
-        async with db.db_manager.get_connection() as conn:
-             cursor = await conn.execute("""
-                SELECT key, value FROM settings 
-                WHERE key IN (
-                    'ai_provider', 
-                    'gemini_model_filter', 'gemini_model_verification', 'gemini_model_autoreply',
-                    'openai_model_filter', 'openai_model_verification', 'openai_model_autoreply'
-                )
-             """)
-             settings = {row[0]: row[1] for row in await cursor.fetchall()}
+        settings = await settings_store.get_many(AI_SETTING_KEYS)
              
         current_provider = settings.get('ai_provider', 'gemini')
         
@@ -1081,10 +1255,12 @@ async def handle_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
             f"当前提供商: `{provider_name}`\n\n"
             f"**Gemini 模型**:\n"
             f"• 审查: `{settings.get('gemini_model_filter', 'N/A')}`\n"
+            f"• 初审: `{settings.get('gemini_model_triage', 'N/A')}`\n"
             f"• 验证: `{settings.get('gemini_model_verification', 'N/A')}`\n"
             f"• 回复: `{settings.get('gemini_model_autoreply', 'N/A')}`\n\n"
             f"**OpenAI 模型**:\n"
             f"• 审查: `{settings.get('openai_model_filter', 'N/A')}`\n"
+            f"• 初审: `{settings.get('openai_model_triage', 'N/A')}`\n"
             f"• 验证: `{settings.get('openai_model_verification', 'N/A')}`\n"
             f"• 回复: `{settings.get('openai_model_autoreply', 'N/A')}`\n\n"
             f"请选择要配置的项目:"
@@ -1115,22 +1291,11 @@ async def handle_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
         if not await db.is_admin(user_id): return
         
         new_provider = data.split("_")[3]
-        async with db.db_manager.get_connection() as conn:
-            await conn.execute("UPDATE settings SET value = ? WHERE key = 'ai_provider'", (new_provider,))
-            await conn.commit()
+        await settings_store.set('ai_provider', new_provider)
             
         await query.answer(f"已切换 AI 提供商为 {new_provider.upper()}")
         
-        async with db.db_manager.get_connection() as conn:
-             cursor = await conn.execute("""
-                SELECT key, value FROM settings 
-                WHERE key IN (
-                    'ai_provider', 
-                    'gemini_model_filter', 'gemini_model_verification', 'gemini_model_autoreply',
-                    'openai_model_filter', 'openai_model_verification', 'openai_model_autoreply'
-                )
-             """)
-             settings = {row[0]: row[1] for row in await cursor.fetchall()}
+        settings = await settings_store.get_many(AI_SETTING_KEYS)
              
         current_provider = settings.get('ai_provider', 'gemini')
         provider_name = "Gemini" if current_provider == 'gemini' else "OpenAI"
@@ -1140,10 +1305,12 @@ async def handle_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
             f"当前提供商: `{provider_name}`\n\n"
             f"**Gemini 模型**:\n"
             f"• 审查: `{settings.get('gemini_model_filter', 'N/A')}`\n"
+            f"• 初审: `{settings.get('gemini_model_triage', 'N/A')}`\n"
             f"• 验证: `{settings.get('gemini_model_verification', 'N/A')}`\n"
             f"• 回复: `{settings.get('gemini_model_autoreply', 'N/A')}`\n\n"
             f"**OpenAI 模型**:\n"
             f"• 审查: `{settings.get('openai_model_filter', 'N/A')}`\n"
+            f"• 初审: `{settings.get('openai_model_triage', 'N/A')}`\n"
             f"• 验证: `{settings.get('openai_model_verification', 'N/A')}`\n"
             f"• 回复: `{settings.get('openai_model_autoreply', 'N/A')}`\n\n"
             f"请选择要配置的项目:"
@@ -1171,6 +1338,7 @@ async def handle_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
         
         keyboard = [
             [InlineKeyboardButton("内容审查模型", callback_data=f"ai_select_model_{provider_type}_filter")],
+            [InlineKeyboardButton("快速初审模型", callback_data=f"ai_select_model_{provider_type}_triage")],
             [InlineKeyboardButton("验证码生成模型", callback_data=f"ai_select_model_{provider_type}_verification")],
             [InlineKeyboardButton("自动回复模型", callback_data=f"ai_select_model_{provider_type}_autoreply")],
             [InlineKeyboardButton("返回设置", callback_data="panel_ai_settings")]
@@ -1202,7 +1370,7 @@ async def handle_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
         keyboard = []
         
         p_code = 'g' if provider_type == 'gemini' else 'o'
-        f_map = {'filter': 'f', 'verification': 'v', 'autoreply': 'a'}
+        f_map = {'filter': 'f', 'triage': 't', 'verification': 'v', 'autoreply': 'a'}
         f_code = f_map.get(feature_type, 'f')
 
         for model in models[:20]:
@@ -1212,6 +1380,7 @@ async def handle_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
         
         feature_name_map = {
             'filter': '内容审查',
+            'triage': '快速初审',
             'verification': '验证码生成',
             'autoreply': '自动回复'
         }
@@ -1232,22 +1401,21 @@ async def handle_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
             return
             
         p_map = {'g': 'gemini', 'o': 'openai'}
-        f_map = {'f': 'filter', 'v': 'verification', 'a': 'autoreply'}
+        f_map = {'f': 'filter', 't': 'triage', 'v': 'verification', 'a': 'autoreply'}
         
         provider_type = p_map.get(p_code, 'gemini')
         feature_type = f_map.get(f_code, 'filter')
         
         setting_key = f"{provider_type}_model_{feature_type}"
         
-        async with db.db_manager.get_connection() as conn:
-            await conn.execute("UPDATE settings SET value = ? WHERE key = ?", (model_name, setting_key))
-            await conn.commit()
+        await settings_store.set(setting_key, model_name)
             
         await query.answer(f"已设置 {provider_type.upper()} {feature_type} 模型为 {model_name}")
         
         message = f"请选择要配置的 {provider_type.upper()} 功能模型:"
         keyboard = [
             [InlineKeyboardButton("内容审查模型", callback_data=f"ai_select_model_{provider_type}_filter")],
+            [InlineKeyboardButton("快速初审模型", callback_data=f"ai_select_model_{provider_type}_triage")],
             [InlineKeyboardButton("验证码生成模型", callback_data=f"ai_select_model_{provider_type}_verification")],
             [InlineKeyboardButton("自动回复模型", callback_data=f"ai_select_model_{provider_type}_autoreply")],
             [InlineKeyboardButton("返回设置", callback_data="panel_ai_settings")]
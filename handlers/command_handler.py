@@ -202,7 +202,7 @@ async def panel(update: Update, context: ContextTypes.DEFAULT_TYPE):
         [InlineKeyboardButton("黑名单管理", callback_data="panel_blacklist_page_1"), InlineKeyboardButton("所有用户信息", callback_data="panel_stats")],
         [InlineKeyboardButton("被过滤消息", callback_data="panel_filtered_page_1"), InlineKeyboardButton("自动回复管理", callback_data="panel_autoreply")],
         [InlineKeyboardButton("豁免名单管理", callback_data="panel_exemptions_page_1"), InlineKeyboardButton("RSS 功能管理", callback_data="panel_rss")],
-        [InlineKeyboardButton("AI 模型设置", callback_data="panel_ai_settings")],
+        [InlineKeyboardButton("AI 模型设置", callback_data="panel_ai_settings"), InlineKeyboardButton("📊 运行指标", callback_data="panel_metrics")],
     ]
     
     await update.message.reply_text(
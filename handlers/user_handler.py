@@ -2,6 +2,7 @@ from telegram import Update, constants
 from telegram.error import BadRequest
 from telegram.ext import ContextTypes
 import asyncio
+from contextlib import asynccontextmanager
 from database import models as db
 from services.verification import (
     create_verification, is_verification_pending, get_pending_verification_message,
@@ -9,9 +10,13 @@ from services.verification import (
     create_cloudflare_verification, is_cloudflare_verification_pending
 )
 from services.thread_manager import get_or_create_thread
+from services.topic_state import topic_state, is_invalid_topic_error
 from services.gemini_service import gemini_service
-from utils.media_converter import sticker_to_image
+from services.ai_service import is_autoreply_refusal
+from utils.media_converter import get_media_unique_id, load_message_image
 from utils.message_sender import send_message_by_type
+from services.answer_cache import answer_cache
+from services.outbound import outbound, LANE_USER
 from services.rate_limiter import rate_limiter
 from config import config
 
@@ -55,7 +60,95 @@ async def handle_invalid_thread(update: Update, context: ContextTypes.DEFAULT_TY
 async def _resend_message(update: Update, context: ContextTypes.DEFAULT_TYPE, thread_id: int):
     return await send_message_by_type(context.bot, update.message, config.FORUM_GROUP_ID, thread_id, True)
 
+# 流式回复先攒够这么多字再发出第一段，以便识别"抱歉，我无法根据现有知识库……"这类拒答
+_STREAM_HOLD_CHARS = 20
+
+class _UserLocks:
+    """handle_message 以非阻塞方式运行（block=False），不同用户的消息并发处理；
+    同一用户的消息持有同一把锁，按到达顺序逐条处理。锁在没有等待者时释放，不随用户数增长。"""
+
+    def __init__(self):
+        self._locks = {}
+
+    @asynccontextmanager
+    async def hold(self, user_id: int):
+        entry = self._locks.get(user_id)
+        if entry is None:
+            entry = self._locks[user_id] = [asyncio.Lock(), 0]
+        entry[1] += 1
+        try:
+            async with entry[0]:
+                yield
+        finally:
+            entry[1] -= 1
+            if not entry[1]:
+                del self._locks[user_id]
+
+_user_locks = _UserLocks()
+
+def _send_to_user(message, factory):
+    """发给用户私聊的消息（含编辑）同样经过统一出口，按私聊限速排队"""
+    return outbound.send(LANE_USER, message.chat_id, factory)
+
+async def _reply_markdown(message, text: str):
+    try:
+        return await _send_to_user(message, lambda: message.reply_text(text, parse_mode='Markdown'))
+    except Exception as e:
+        print(f"Markdown解析失败，使用纯文本: {e}")
+        return await _send_to_user(message, lambda: message.reply_text(text))
+
+async def _send_streaming_autoreply(message, chunks) -> str:
+    """边生成边发送自动回复：先发出开头，之后按 AUTOREPLY_STREAM_EDIT_INTERVAL 限速编辑消息，
+    结束时以 Markdown 格式更新为完整回复。返回完整回复；拒答或生成失败时返回 None。"""
+    loop = asyncio.get_running_loop()
+    text = ""
+    shown = ""
+    sent = None
+    last_edit = 0.0
+    try:
+        async for chunk in chunks:
+            text += chunk
+            if sent is None:
+                if len(text) < _STREAM_HOLD_CHARS or is_autoreply_refusal(text):
+                    continue
+                sent = await _send_to_user(message, lambda: message.reply_text(text))
+                shown, last_edit = text, loop.time()
+            elif loop.time() - last_edit >= config.AUTOREPLY_STREAM_EDIT_INTERVAL and text.strip() != shown.strip():
+                try:
+                    await _send_to_user(message, lambda: sent.edit_text(text))
+                    shown = text
+                except BadRequest as e:
+                    print(f"更新流式自动回复失败: {e}")
+                last_edit = loop.time()
+    except Exception as e:
+        print(f"流式自动回复生成失败: {e!r}")
+        text = ""
+
+    text = text.strip()
+    if not text or is_autoreply_refusal(text):
+        if sent is not None:
+            try:
+                await sent.delete()
+            except Exception as e:
+                print(f"删除不完整的自动回复失败: {e}")
+        return None
+
+    if sent is None:
+        await _reply_markdown(message, text)
+        return text
+    try:
+        await _send_to_user(message, lambda: sent.edit_text(text, parse_mode='Markdown'))
+    except BadRequest as e:
+        if text != shown.strip():
+            print(f"Markdown解析失败，使用纯文本: {e}")
+            await _send_to_user(message, lambda: sent.edit_text(text))
+    return text
+
 async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    async with _user_locks.hold(update.effective_user.id):
+        await _handle_message(update, context)
+
+async def _handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user = update.effective_user
     
     is_over_limit, was_warned = await rate_limiter.check_user_rate_limit(user.id)
@@ -87,9 +180,13 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
         if context.user_data['pending_update'].update_id == update.update_id:
             context.user_data.pop('pending_update')
     
-    is_blocked, is_permanent = await db.is_blacklisted(user.id)
-    if is_blocked:
-        if is_permanent:
+    gate = await db.get_user_gate_snapshot(user.id)
+    if not gate['is_verified'] and config.VERIFICATION_USE_CLOUDFLARE:
+        # Cloudflare 验证在 cloudflare_web 进程中完成，本进程缓存的验证状态可能已经过时
+        db.invalidate_user_cache(user.id)
+        gate = await db.get_user_gate_snapshot(user.id)
+    if gate['is_blacklisted']:
+        if gate['blacklist_permanent']:
             await update.message.reply_text("你已被永久封禁，如有疑问请联系管理员。")
             return
         
@@ -105,9 +202,7 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
             await update.message.reply_text(message)
         return
     
-    user_data = await db.get_user(user.id)
-    
-    if not user_data:
+    if not gate['user_exists']:
         await db.add_user(
             user_id=user.id,
             username=user.username,
@@ -122,9 +217,8 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
             "不过，在你发送第一条消息前，请先完成人机验证。"
         )
         await update.message.reply_text(welcome_message)
-        user_data = await db.get_user(user.id)
 
-    if not user_data.get('is_verified'):
+    if not gate['is_verified']:
         if not config.VERIFICATION_ENABLED:
             await db.update_user_verification(user.id, is_verified=True)
         else:
@@ -132,7 +226,7 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
             
             # 检查是否使用 Cloudflare 验证
             if config.VERIFICATION_USE_CLOUDFLARE:
-                has_pending, is_expired = is_cloudflare_verification_pending(user.id)
+                has_pending, is_expired = await is_cloudflare_verification_pending(user.id)
                 
                 if has_pending and not is_expired:
                     await update.message.reply_text(
@@ -149,7 +243,7 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
                     return
             
             # 获取用户的个人验证模式偏好，如果没有则使用全局配置
-            user_verification_mode = await db.get_user_verification_mode(user.id)
+            user_verification_mode = gate['verification_mode']
             use_image_verification = config.VERIFICATION_USE_IMAGE
             
             if user_verification_mode == "image":
@@ -160,7 +254,7 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
             
             if use_image_verification:
                 # 使用图片验证码
-                has_pending, is_expired = is_image_verification_pending(user.id)
+                has_pending, is_expired = await is_image_verification_pending(user.id)
                 
                 if has_pending and not is_expired:
                     # 已有待处理的图片验证，不需要重新生成
@@ -179,10 +273,10 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
                     return
             else:
                 # 使用文本验证码
-                has_pending, is_expired = is_verification_pending(user.id)
+                has_pending, is_expired = await is_verification_pending(user.id)
                 
                 if has_pending and not is_expired:
-                    verification_data = get_pending_verification_message(user.id)
+                    verification_data = await get_pending_verification_message(user.id)
                     if verification_data:
                         question, keyboard = verification_data
                         await update.message.reply_text(
@@ -197,30 +291,23 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
                     return
     
     message = update.message
-    image_bytes = None
-
-    if message.photo:
-        photo_file = await message.photo[-1].get_file()
-        image_bytes = await photo_file.download_as_bytearray()
-    elif message.sticker and not message.sticker.is_animated and not message.sticker.is_video:
-        sticker_file = await message.sticker.get_file()
-        sticker_bytes = await sticker_file.download_as_bytearray()
-        image_bytes = await sticker_to_image(sticker_bytes)
+    # 图片延迟到审查缓存未命中时才下载
+    media_id = get_media_unique_id(message)
 
     if message.video or message.animation:
         pass
     else:
-        is_exempted = await db.is_exempted(user.id)
-        ai_check_disabled = await db.is_ai_check_disabled(user.id)
+        is_exempted = gate['is_exempted']
+        ai_check_disabled = gate['ai_check_disabled']
         
         if not is_exempted and not ai_check_disabled:
             analyzing_message = None
             try:
-                analyzing_message = await context.bot.send_message(
+                analyzing_message = await _send_to_user(message, lambda: context.bot.send_message(
                     chat_id=message.chat_id,
                     text="正在通过AI分析内容是否包含垃圾信息...",
                     reply_to_message_id=message.message_id
-                )
+                ))
 
                 # 检查消息是否为JSON格式
                 message_text = message.text or message.caption or ""
@@ -237,7 +324,9 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 
                 # 如果JSON分析失败或不是JSON，进行普通分析
                 if analysis_result is None:
-                    analysis_result = await gemini_service.analyze_message(message, image_bytes)
+                    analysis_result = await gemini_service.analyze_message(
+                        message, media_id=media_id, load_image=lambda: load_message_image(message)
+                    )
                 
                 if analysis_result.get("is_spam"):
                     await db.save_filtered_message(
@@ -249,7 +338,9 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
                         media_file_id=message.photo and message.photo[-1].file_id or message.sticker and message.sticker.file_id,
                     )
                     reason = analysis_result.get("reason", "未提供原因")
-                    await analyzing_message.edit_text(f"您的消息已被系统拦截，因此未被转发\n\n原因：{reason}")
+                    await _send_to_user(message, lambda: analyzing_message.edit_text(
+                        f"您的消息已被系统拦截，因此未被转发\n\n原因：{reason}"
+                    ))
                     return
                 else:
                     await analyzing_message.delete()
@@ -277,94 +368,91 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if is_new:
         return
     
-    try:
-        probe_msg = await context.bot.forward_message(
-            chat_id=config.FORUM_GROUP_ID,
-            from_chat_id=config.FORUM_GROUP_ID,
-            message_id=thread_id,
-            message_thread_id=thread_id,
-            disable_notification=True
-        )
-        await context.bot.delete_message(
-            chat_id=config.FORUM_GROUP_ID,
-            message_id=probe_msg.message_id
-        )
-    except BadRequest as e:
-        error_text = e.message.lower()
-        if "message to forward not found" in error_text or \
-           "message not found" in error_text or \
-           "thread not found" in error_text or \
-           "topic not found" in error_text:
-            await handle_invalid_thread(update, context, user.id)
-            return
-        print(f"Topic probe failed with unexpected error: {e}")
+    if topic_state.get(thread_id) is False:
+        await handle_invalid_thread(update, context, user.id)
+        return
     
     try:
-        sent_msg = None
         if message.text:
-            sent_msg = await context.bot.send_message(
+            sent_msg = await outbound.send(LANE_USER, config.FORUM_GROUP_ID, lambda: context.bot.send_message(
                 chat_id=config.FORUM_GROUP_ID,
                 text=message.text,
                 entities=message.entities,
                 message_thread_id=thread_id,
                 disable_web_page_preview=True
-            )
-            forwarded_message_id = sent_msg.message_id
+            ))
         else:
-            await _resend_message(update, context, thread_id)
-            return
+            sent_msg = await _resend_message(update, context, thread_id)
     except BadRequest as e:
-        if "thread not found" in e.message.lower() or "topic not found" in e.message.lower():
+        if is_invalid_topic_error(e.message):
+            topic_state.record_failure(thread_id)
             await handle_invalid_thread(update, context, user.id)
             return
         else:
             print(f"发送消息时发生未知错误: {e}")
             await update.message.reply_text("发送消息时发生未知错误，请稍后再试。")
             return
+
+    if not topic_state.record_send(thread_id, sent_msg):
+        # 话题已被删除，消息落到了其他话题：撤回后按话题失效处理
+        try:
+            await sent_msg.delete()
+        except Exception as e:
+            print(f"撤回误投的消息失败: {e}")
+        await handle_invalid_thread(update, context, user.id)
+        return
+    if not message.text:
+        return
+    forwarded_message_id = sent_msg.message_id
     
-    if message.text and await db.get_autoreply_enabled():
-        knowledge_base_content = await db.get_all_knowledge_content()
-        if knowledge_base_content:
-            autoreply_text = await gemini_service.generate_autoreply(
-                message.text,
-                knowledge_base_content
-            )
+    if message.text and gate['autoreply_enabled']:
+        autoreply_text = answer_cache.get(message.text)
+        if autoreply_text is not None:
+            await _reply_markdown(update.message, autoreply_text)
+        else:
+            knowledge_version = answer_cache.version
+            knowledge_base_content = await db.get_relevant_knowledge_content(message.text)
+            if knowledge_base_content:
+                if config.AUTOREPLY_STREAMING:
+                    autoreply_text = await _send_streaming_autoreply(
+                        update.message,
+                        gemini_service.stream_autoreply(message.text, knowledge_base_content)
+                    )
+                else:
+                    autoreply_text = await gemini_service.generate_autoreply(
+                        message.text,
+                        knowledge_base_content
+                    )
+                    if autoreply_text:
+                        await _reply_markdown(update.message, autoreply_text)
+                answer_cache.put(message.text, autoreply_text, knowledge_version)
             
-            if autoreply_text:
+        if autoreply_text:
+            if forwarded_message_id:
+                admin_notification = (
+                    f"自动回复内容:\n\n"
+                    f"{autoreply_text}"
+                )
                 try:
-                    await update.message.reply_text(
-                        autoreply_text,
+                    await outbound.send(LANE_USER, config.FORUM_GROUP_ID, lambda: context.bot.send_message(
+                        chat_id=config.FORUM_GROUP_ID,
+                        text=admin_notification,
+                        message_thread_id=thread_id,
+                        reply_to_message_id=forwarded_message_id,
                         parse_mode='Markdown'
-                    )
+                    ))
                 except Exception as e:
-                    print(f"Markdown解析失败，使用纯文本: {e}")
-                    await update.message.reply_text(autoreply_text)
-                
-                if forwarded_message_id:
-                    admin_notification = (
-                        f"自动回复内容:\n\n"
-                        f"{autoreply_text}"
-                    )
+                    print(f"发送自动回复通知给管理员失败（Markdown），尝试纯文本: {e}")
                     try:
-                        await context.bot.send_message(
+                        admin_notification_plain = (
+                            f"自动回复内容:\n\n"
+                            f"{autoreply_text}"
+                        )
+                        await outbound.send(LANE_USER, config.FORUM_GROUP_ID, lambda: context.bot.send_message(
                             chat_id=config.FORUM_GROUP_ID,
-                            text=admin_notification,
+                            text=admin_notification_plain,
                             message_thread_id=thread_id,
-                            reply_to_message_id=forwarded_message_id,
-                            parse_mode='Markdown'
-                        )
-                    except Exception as e:
-                        print(f"发送自动回复通知给管理员失败（Markdown），尝试纯文本: {e}")
-                        try:
-                            admin_notification_plain = (
-                                f"自动回复内容:\n\n"
-                                f"{autoreply_text}"
-                            )
-                            await context.bot.send_message(
-                                chat_id=config.FORUM_GROUP_ID,
-                                text=admin_notification_plain,
-                                message_thread_id=thread_id,
-                                reply_to_message_id=forwarded_message_id
-                            )
-                        except Exception as e2:
-                            print(f"发送自动回复通知给管理员失败: {e2}")
+                            reply_to_message_id=forwarded_message_id
+                        ))
+                    except Exception as e2:
+                        print(f"发送自动回复通知给管理员失败: {e2}")
@@ -5,6 +5,7 @@ from typing import Dict, Any, Optional
 from telegram.ext import ContextTypes
 from telegram import constants
 from config import config
+from services.outbound import outbound, LANE_RSS
 from . import data_manager, retry_utils, settings
 
 logger = logging.getLogger(__name__)
@@ -25,12 +26,19 @@ async def send_telegram_message(
         if custom_footer:
             text += f"\n---\n{custom_footer}"
 
+        # 限流和 RetryAfter 由统一发送出口处理（全部发送一起暂停），这里只重试网络错误；
+        # 发送出口多次重试后仍抛出的 RetryAfter 直接放弃，不在每个订阅的协程里各自等待
         await retry_utils.retry_telegram_api(
-            context.bot.send_message,
-            chat_id=chat_id,
-            text=text,
-            parse_mode=constants.ParseMode.HTML,
-            disable_web_page_preview=not link_preview_enabled,
+            outbound.send,
+            LANE_RSS,
+            chat_id,
+            lambda: context.bot.send_message(
+                chat_id=chat_id,
+                text=text,
+                parse_mode=constants.ParseMode.HTML,
+                disable_web_page_preview=not link_preview_enabled,
+            ),
+            is_retryable=retry_utils.is_retryable_network_error,
         )
     except Exception as exc:
         logger.error("向 %s 发送消息时出错: %s", chat_id, exc)
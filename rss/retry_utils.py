@@ -32,6 +32,13 @@ def is_retryable_error(exception: Exception) -> bool:
     return True
 
 
+def is_retryable_network_error(exception: Exception) -> bool:
+    """RetryAfter 交给调用方（统一发送出口）按全局暂停处理，不在这里单独等待重试"""
+    if isinstance(exception, tg_error.RetryAfter):
+        return False
+    return is_retryable_error(exception)
+
+
 async def retry_telegram_api(
     func: Callable[..., Any],
     *args,
@@ -39,6 +46,7 @@ async def retry_telegram_api(
     initial_delay: float = DEFAULT_INITIAL_DELAY,
     max_delay: float = DEFAULT_MAX_DELAY,
     backoff_factor: float = DEFAULT_BACKOFF_FACTOR,
+    is_retryable: Callable[[Exception], bool] = is_retryable_error,
     **kwargs,
 ) -> Any:
     last_exception = None
@@ -49,7 +57,7 @@ async def retry_telegram_api(
         except Exception as exc:
             last_exception = exc
 
-            if not is_retryable_error(exc):
+            if not is_retryable(exc):
                 logger.error("遇到不可重试的错误: %s: %s", type(exc).__name__, exc)
                 raise
 
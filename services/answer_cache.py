@@ -0,0 +1,72 @@
+import re
+import time
+from collections import OrderedDict
+from config import config
+from database.knowledge_index import knowledge_index
+from services.verdict_cache import VerdictCache
+
+_PUNCTUATION_RE = re.compile(r'[\W_]+')
+
+class AnswerCache:
+    """自动回复答案缓存。
+
+    键为归一化后的问题（忽略大小写、全半角、空白和标点），内存中按 LRU + TTL 保存。
+    知识条目增改删会递增知识库版本号，版本号变化后整个缓存作废。
+    """
+
+    def __init__(self, max_entries: int = 1000, ttl: float = 86400):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._data = OrderedDict()
+        self._version = knowledge_index.version
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def normalize_question(text: str) -> str:
+        return _PUNCTUATION_RE.sub('', VerdictCache.normalize_text(text))
+
+    @property
+    def version(self) -> int:
+        return knowledge_index.version
+
+    def _check_version(self):
+        if self._version != knowledge_index.version:
+            self._version = knowledge_index.version
+            self._data.clear()
+
+    def get(self, question: str):
+        self._check_version()
+        key = self.normalize_question(question)
+        entry = self._data.get(key)
+        if entry is not None:
+            answer, expires_at = entry
+            if expires_at > time.time():
+                self._data.move_to_end(key)
+                self.hits += 1
+                return answer
+            del self._data[key]
+        self.misses += 1
+        return None
+
+    def put(self, question: str, answer: str, version: int = None):
+        """version 为生成答案前读取的 self.version；生成期间知识库被修改时不缓存该答案"""
+        self._check_version()
+        key = self.normalize_question(question)
+        if self.max_entries <= 0 or not answer or not key or (version is not None and version != self._version):
+            return
+        self._data[key] = (answer, time.time() + self.ttl)
+        self._data.move_to_end(key)
+        while len(self._data) > self.max_entries:
+            self._data.popitem(last=False)
+
+    def stats(self) -> dict:
+        total = self.hits + self.misses
+        return {
+            "entries": len(self._data),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / total if total else 0.0,
+        }
+
+answer_cache = AnswerCache(config.AUTOREPLY_CACHE_SIZE, config.AUTOREPLY_CACHE_TTL)
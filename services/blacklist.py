@@ -1,11 +1,12 @@
-import time
 from telegram import InlineKeyboardButton, InlineKeyboardMarkup
 from telegram.helpers import escape_markdown
 from database import models as db
-from services.gemini_service import gemini_service
+from database.session_store import session_store, SessionRecord
+from services.challenge_pool import challenge_pool
 from config import config
 
-pending_unblocks = {}
+# 会话存储中解封验证会话的 kind
+KIND_UNBLOCK = 'unblock'
 
 async def block_user(user_id: int, reason: str, admin_id: int, permanent: bool = False):
     await db.add_to_blacklist(user_id, reason, admin_id, permanent)
@@ -16,31 +17,25 @@ async def unblock_user(user_id: int):
     await db.set_user_blacklist_strikes(user_id, 0)
     return f"用户 {user_id} 已被管理员解封。"
 
-def is_unblock_pending(user_id: int) -> tuple[bool, bool]:
-    if user_id not in pending_unblocks:
-        return False, True
-    
-    session = pending_unblocks[user_id]
-    is_expired = time.time() - session['created_at'] > config.VERIFICATION_TIMEOUT
-    
-    if is_expired:
-        del pending_unblocks[user_id]
+async def _get_pending_unblock(user_id: int):
+    session = await session_store.get(KIND_UNBLOCK, user_id)
+    if session is not None and session.is_expired():
+        await session_store.delete(KIND_UNBLOCK, user_id)
+        return None
+    return session
+
+async def is_unblock_pending(user_id: int) -> tuple[bool, bool]:
+    if await _get_pending_unblock(user_id) is None:
         return False, True
-    
     return True, False
 
-def get_pending_unblock_message(user_id: int):
-    if user_id not in pending_unblocks:
+async def get_pending_unblock_message(user_id: int):
+    session = await _get_pending_unblock(user_id)
+    if session is None:
         return None
     
-    session = pending_unblocks[user_id]
-    
-    if time.time() - session['created_at'] > config.VERIFICATION_TIMEOUT:
-        del pending_unblocks[user_id]
-        return None
-    
-    question = session['question']
-    options = session['options']
+    question = session.question
+    options = session.options
     
     keyboard = [
         [InlineKeyboardButton(option, callback_data=f"unblock_{option}") for option in options]
@@ -54,10 +49,10 @@ async def start_unblock_process(user_id: int):
     if is_permanent:
         return "您已被管理员永久封禁，无法通过申诉解封。", None
 
-    has_pending, is_expired = is_unblock_pending(user_id)
+    has_pending, is_expired = await is_unblock_pending(user_id)
     
     if has_pending and not is_expired:
-        unblock_data = get_pending_unblock_message(user_id)
+        unblock_data = await get_pending_unblock_message(user_id)
         if unblock_data:
             question, keyboard = unblock_data
             return (
@@ -66,17 +61,13 @@ async def start_unblock_process(user_id: int):
                 f"如果您认为这是误操作，请回答以下问题以自动解封：\n\n{question}"
             ), keyboard
     
-    challenge = await gemini_service.generate_unblock_question()
+    challenge = challenge_pool.get()
     question = challenge['question']
     correct_answer = challenge['correct_answer']
     options = challenge['options']
     
-    pending_unblocks[user_id] = {
-        'answer': correct_answer,
-        'question': question,
-        'options': options,
-        'created_at': time.time()
-    }
+    session = SessionRecord(answer=correct_answer, question=question, options=options)
+    await session_store.set(KIND_UNBLOCK, user_id, session, session.expires_at)
     
     keyboard = [
         [InlineKeyboardButton(option, callback_data=f"unblock_{option}") for option in options]
@@ -88,22 +79,19 @@ async def start_unblock_process(user_id: int):
     ), InlineKeyboardMarkup(keyboard)
 
 async def verify_unblock_answer(user_id: int, user_answer: str):
-    if user_id not in pending_unblocks:
+    # 解封只有一次作答机会：原子地取出并删除会话，同一会话的并发回答只有一个能继续
+    session = await session_store.update(KIND_UNBLOCK, user_id, lambda session: (None, 0, session))
+    if session is None:
         return "解封会话已过期或不存在。", False
 
-    session = pending_unblocks[user_id]
-    
-    if time.time() - session['created_at'] > config.VERIFICATION_TIMEOUT:
-        del pending_unblocks[user_id]
+    if session.is_expired():
         return "解封超时，请重新发送消息以获取新问题。", False
 
-    if user_answer == session['answer']:
-        del pending_unblocks[user_id]
+    if user_answer == session.answer:
         await db.remove_from_blacklist(user_id)
         await db.set_user_blacklist_strikes(user_id, 0)
         return "解封成功！您现在可以正常发送消息了。", True
     else:
-        del pending_unblocks[user_id]
         await db.add_to_blacklist(user_id, reason="解封验证失败", blocked_by=config.BOT_ID, permanent=True)
         return "答案错误，解封失败。您已被永久封禁。", False
 
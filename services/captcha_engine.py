@@ -0,0 +1,155 @@
+import asyncio
+import io
+import random
+import string
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+from PIL import Image, ImageDraw, ImageFont
+from config import config
+
+CAPTCHA_TYPES = ('digits', 'letters', 'mixed')
+FONT_PATH = "/usr/share/fonts/truetype/dejavu/DejaVuSans-Bold.ttf"
+
+_CHARSETS = {
+    'digits': string.digits,
+    'letters': string.ascii_uppercase,
+    'mixed': string.digits + string.ascii_uppercase,
+}
+
+@lru_cache(maxsize=4)
+def _load_font(size: int):
+    # 字体只从磁盘加载一次；FreeTypeFont 只读使用，可在线程间共享
+    try:
+        return ImageFont.truetype(FONT_PATH, size)
+    except Exception:
+        return ImageFont.load_default()
+
+def generate_captcha_options(correct_answer: str, captcha_type: str = "mixed") -> list:
+    """为验证码生成多个选项"""
+    charset = _CHARSETS.get(captcha_type, _CHARSETS['mixed'])
+    options = [correct_answer]
+    while len(options) < 4:
+        wrong_option = ''.join(random.choices(charset, k=4))
+        if wrong_option not in options:
+            options.append(wrong_option)
+    random.shuffle(options)
+    return options
+
+def render_captcha(captcha_type: str = "mixed") -> dict:
+    """生成一张图片验证码（同步、CPU 密集，应在线程池中调用）
+    captcha_type: 'digits' (纯数字), 'letters' (纯字母), 'mixed' (混合)
+    """
+    if captcha_type not in _CHARSETS:
+        captcha_type = 'digits'
+    captcha_text = ''.join(random.choices(_CHARSETS[captcha_type], k=4))
+
+    width, height = 200, 80
+    image = Image.new('RGB', (width, height), color='white')
+    draw = ImageDraw.Draw(image)
+    font = _load_font(40)
+
+    text_color = (random.randint(0, 100), random.randint(0, 100), random.randint(0, 100))
+
+    # 绘制干扰线
+    for _ in range(3):
+        x1 = random.randint(0, width)
+        y1 = random.randint(0, height)
+        x2 = random.randint(0, width)
+        y2 = random.randint(0, height)
+        draw.line([(x1, y1), (x2, y2)], fill=(200, 200, 200), width=1)
+
+    # 绘制干扰点
+    for _ in range(50):
+        x = random.randint(0, width)
+        y = random.randint(0, height)
+        draw.point((x, y), fill=(200, 200, 200))
+
+    # 绘制文字
+    text_bbox = draw.textbbox((0, 0), captcha_text, font=font)
+    text_width = text_bbox[2] - text_bbox[0]
+    text_height = text_bbox[3] - text_bbox[1]
+    x = (width - text_width) // 2
+    y = (height - text_height) // 2
+    draw.text((x, y), captcha_text, fill=text_color, font=font)
+
+    img_byte_arr = io.BytesIO()
+    image.save(img_byte_arr, format='PNG')
+
+    return {
+        "type": "image",
+        "captcha_text": captcha_text,
+        "image_bytes": img_byte_arr.getvalue(),
+        "options": generate_captcha_options(captcha_text, captcha_type)
+    }
+
+class CaptchaEngine:
+    """图片验证码渲染引擎。
+
+    渲染在独立线程池中进行，不占用事件循环；每种类型维护一个预渲染好的环形队列，
+    get() 直接取出一张，取用后在后台补足。队列为空时才会等待现场渲染。
+    """
+
+    def __init__(self, ring_size: int = 10, workers: int = 2):
+        self.ring_size = ring_size
+        self._executor = ThreadPoolExecutor(max_workers=max(1, workers), thread_name_prefix='captcha')
+        self._rings = {captcha_type: deque() for captcha_type in CAPTCHA_TYPES}
+        self._refill_tasks = {}
+        self._closed = False
+        self.served = 0
+        self.rendered_on_demand = 0
+
+    async def _render(self, captcha_type: str) -> dict:
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, render_captcha, captcha_type)
+
+    async def get(self, captcha_type: str = "mixed") -> dict:
+        if captcha_type not in self._rings:
+            captcha_type = 'digits'
+        ring = self._rings[captcha_type]
+        if ring:
+            item = ring.popleft()
+            self.served += 1
+        else:
+            item = await self._render(captcha_type)
+            self.rendered_on_demand += 1
+        self._ensure_refill(captcha_type)
+        return item
+
+    def start(self, *captcha_types):
+        for captcha_type in captcha_types or CAPTCHA_TYPES:
+            self._ensure_refill(captcha_type)
+
+    def _ensure_refill(self, captcha_type: str):
+        task = self._refill_tasks.get(captcha_type)
+        if self._closed or self.ring_size <= 0 or (task is not None and not task.done()):
+            return
+        if len(self._rings[captcha_type]) >= self.ring_size:
+            return
+        self._refill_tasks[captcha_type] = asyncio.get_running_loop().create_task(self._refill(captcha_type))
+
+    async def _refill(self, captcha_type: str):
+        ring = self._rings[captcha_type]
+        try:
+            while len(ring) < self.ring_size:
+                ring.append(await self._render(captcha_type))
+        except Exception as e:
+            print(f"预渲染图片验证码失败: {e}")
+
+    async def close(self):
+        """取消并等待后台预渲染任务，然后关闭渲染线程池"""
+        self._closed = True
+        tasks = list(self._refill_tasks.values())
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        self._executor.shutdown(wait=False, cancel_futures=True)
+
+    def stats(self) -> dict:
+        return {
+            "ready": {captcha_type: len(ring) for captcha_type, ring in self._rings.items()},
+            "served": self.served,
+            "rendered_on_demand": self.rendered_on_demand,
+        }
+
+captcha_engine = CaptchaEngine(config.CAPTCHA_RING_SIZE, config.CAPTCHA_RENDER_WORKERS)
@@ -0,0 +1,116 @@
+import asyncio
+import random
+from collections import deque
+from config import config
+from services.ai_service import ai_service, LOCAL_VERIFICATION_QUESTIONS
+
+_LOCAL_QUESTIONS = {item['question'] for item in LOCAL_VERIFICATION_QUESTIONS}
+
+# 选项会放进 callback_data（如 "unblock_" + 选项），Telegram 限制为 64 字节
+_MAX_OPTION_BYTES = 48
+
+class ChallengePool:
+    """预先生成的文本验证/解封问题池。
+
+    get() 立即返回池中的问题，池为空时使用本地题库；池内数量低于一半时在后台补充，
+    补充时最多同时发出 concurrency 个 AI 请求，新用户集中涌入也不会变成一波 AI 调用。
+    """
+
+    # 一轮补充没有得到任何可用题目后，至少等待这么多秒再重试
+    RETRY_DELAY = 30
+
+    def __init__(self, size: int = 20, concurrency: int = 2):
+        self.size = size
+        self.concurrency = max(1, concurrency)
+        self._items = deque()
+        self._questions = set()
+        self._refill_task = None
+        self._retry_after = 0.0
+        self._closed = False
+        self.served = 0
+        self.fallbacks = 0
+        self.generated = 0
+        self.rejected = 0
+
+    @staticmethod
+    def is_valid(challenge) -> bool:
+        if not isinstance(challenge, dict):
+            return False
+        question = challenge.get('question')
+        answer = challenge.get('correct_answer')
+        options = challenge.get('options')
+        if not isinstance(question, str) or not question.strip() or not isinstance(options, list):
+            return False
+        if not 2 <= len(options) <= 6 or len(set(options)) != len(options) or answer not in options:
+            return False
+        return all(isinstance(option, str) and option and len(option.encode('utf-8')) <= _MAX_OPTION_BYTES
+                   for option in options)
+
+    def get(self) -> dict:
+        self._ensure_refill()
+        if self._items:
+            challenge = self._items.popleft()
+            self._questions.discard(challenge['question'])
+            self.served += 1
+        else:
+            challenge = ai_service.get_local_question()
+            self.fallbacks += 1
+        # 同一道题可能发给不同用户，每次都重新打乱选项顺序
+        options = list(challenge['options'])
+        random.shuffle(options)
+        return {**challenge, 'options': options}
+
+    def start(self):
+        self._ensure_refill()
+
+    def _ensure_refill(self):
+        if self._closed or self.size <= 0 or len(self._items) > self.size // 2:
+            return
+        if self._refill_task is not None and not self._refill_task.done():
+            return
+        loop = asyncio.get_running_loop()
+        if loop.time() < self._retry_after:
+            return
+        self._refill_task = loop.create_task(self._refill())
+
+    async def _refill(self):
+        while len(self._items) < self.size:
+            needed = min(self.concurrency, self.size - len(self._items))
+            results = await asyncio.gather(
+                *(ai_service.generate_verification_challenge() for _ in range(needed)),
+                return_exceptions=True
+            )
+            added = 0
+            for challenge in results:
+                # 提供商失败时会退回本地题库，本地题目不进入池
+                if isinstance(challenge, BaseException) or challenge.get('question') in _LOCAL_QUESTIONS:
+                    continue
+                if not self.is_valid(challenge) or challenge['question'] in self._questions:
+                    self.rejected += 1
+                    continue
+                self._items.append(challenge)
+                self._questions.add(challenge['question'])
+                added += 1
+            self.generated += added
+            if added == 0:
+                # 提供商不可用或只返回重复/无效题目，稍后再试
+                self._retry_after = asyncio.get_running_loop().time() + self.RETRY_DELAY
+                return
+
+    async def close(self):
+        """取消并等待后台补充任务，关闭 AI 客户端和数据库前调用"""
+        self._closed = True
+        if self._refill_task is not None:
+            self._refill_task.cancel()
+            await asyncio.gather(self._refill_task, return_exceptions=True)
+
+    def stats(self) -> dict:
+        return {
+            "available": len(self._items),
+            "served": self.served,
+            "fallbacks": self.fallbacks,
+            "generated": self.generated,
+            "rejected": self.rejected,
+        }
+
+challenge_pool = ChallengePool(config.CHALLENGE_POOL_SIZE, config.CHALLENGE_POOL_CONCURRENCY)
@@ -0,0 +1,102 @@
+import json
+import re
+
+_URL_RE = re.compile(r'(?:https?://|www\.|t\.me/)\S+', re.IGNORECASE)
+
+def _token_cost(char: str) -> float:
+    # 粗略估算：汉字约 1 个 token，其他字符约 4 个一个 token
+    return 1.0 if '㐀' <= char <= '鿿' else 0.25
+
+def estimate_tokens(text: str) -> int:
+    return int(sum(_token_cost(char) for char in text) + 0.999)
+
+def _prefix_length(text: str, budget: float) -> int:
+    used = 0.0
+    for i, char in enumerate(text):
+        used += _token_cost(char)
+        if used > budget:
+            return i
+    return len(text)
+
+def dedupe_lines(text: str):
+    """去掉重复出现的行（忽略首尾空白和大小写），返回 (文本, 去掉的行数)"""
+    seen = set()
+    kept = []
+    dropped = 0
+    for line in text.split('\n'):
+        key = line.strip().lower()
+        if key and key in seen:
+            dropped += 1
+            continue
+        seen.add(key)
+        kept.append(line)
+    return '\n'.join(kept), dropped
+
+def budget_text(text: str, max_tokens: int):
+    """把送审文本控制在约 max_tokens 个 token 以内。
+
+    先去掉重复行；仍然超出时保留开头约 2/3 和结尾约 1/3，并把中间被省略部分里的链接单独列出。
+    链接不设数量上限（否则诱饵链接可以把真正的链接挤出去），预算先留给链接，剩余部分再分给开头和结尾；
+    消息本身的长度限制了链接的总量。
+    返回 (送审文本, 预算记录)；文本未被改动时预算记录为 None。
+    """
+    if not text or max_tokens <= 0:
+        return text, None
+    original_tokens = estimate_tokens(text)
+    if original_tokens <= max_tokens and '\n' not in text:
+        return text, None
+
+    budgeted, duplicate_lines = dedupe_lines(text)
+    omitted_chars = 0
+    urls = []
+    if estimate_tokens(budgeted) > max_tokens:
+        # 按全文的链接预留，实际列出的只是中间部分的链接，不会超出预留
+        url_tokens = estimate_tokens(' '.join(dict.fromkeys(_URL_RE.findall(budgeted))))
+        remaining = max(max_tokens - url_tokens, 0)
+        head_length = _prefix_length(budgeted, remaining * 2 / 3)
+        tail_length = _prefix_length(budgeted[head_length:][::-1], remaining / 3)
+        middle = budgeted[head_length:len(budgeted) - tail_length]
+        omitted_chars = len(middle)
+        urls = list(dict.fromkeys(_URL_RE.findall(middle)))
+        parts = [budgeted[:head_length], f"\n…（省略 {omitted_chars} 字）…\n"]
+        if urls:
+            parts.append("[省略部分中的链接] " + ' '.join(urls) + "\n")
+        parts.append(budgeted[len(budgeted) - tail_length:])
+        budgeted = ''.join(parts)
+
+    if not duplicate_lines and not omitted_chars:
+        return text, None
+    return budgeted, {
+        "original_tokens": original_tokens,
+        "sent_tokens": estimate_tokens(budgeted),
+        "duplicate_lines": duplicate_lines,
+        "omitted_chars": omitted_chars,
+        "urls_kept": len(urls),
+    }
+
+def extract_json_text(json_data: str, max_field_chars: int = 1000) -> str:
+    """从 JSON 消息中提取需要审查的文本字段，过长的字段只保留开头和结尾共 max_field_chars 个字符。
+    JSON 格式错误时抛出 json.JSONDecodeError，没有文本字段时返回空字符串。"""
+    data = json.loads(json_data)
+    if not isinstance(data, dict):
+        return ""
+
+    fields = []
+    # 提取主消息
+    if data.get("message"):
+        fields.append(("消息", data["message"]))
+    # 提取引用文本
+    if isinstance(data.get("reply_to"), dict) and data["reply_to"].get("quote_text"):
+        fields.append(("引用", data["reply_to"]["quote_text"]))
+    # 提取发送者信息（其他数据）
+    if data.get("text"):
+        fields.append(("内容", data["text"]))
+
+    text_contents = []
+    for label, value in fields:
+        value = value if isinstance(value, str) else json.dumps(value, ensure_ascii=False)
+        if len(value) > max_field_chars:
+            tail = max_field_chars // 3
+            value = value[:max_field_chars - tail] + "…" + value[len(value) - tail:]
+        text_contents.append(f"[{label}] {value}")
+    return "\n".join(text_contents)
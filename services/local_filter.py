@@ -0,0 +1,187 @@
+import asyncio
+import math
+import re
+import time
+from config import config
+from database import models as db
+from services.verdict_cache import VerdictCache
+from utils.text_terms import iter_terms
+
+# 本地过滤给出的拦截原因都以此开头，训练时据此排除，避免模型学习自己的输出
+LOCAL_REASON_PREFIX = "本地过滤："
+
+_HOST_RE = re.compile(r'(?:https?://)?((?:[a-z0-9](?:[a-z0-9-]*[a-z0-9])?\.)+[a-z]{2,})', re.IGNORECASE)
+
+def extract_hosts(text: str) -> set:
+    return {host.lower() for host in _HOST_RE.findall(text or "")}
+
+def tokenize(text: str) -> set:
+    """英文/数字按词切分，中文按相邻两字切分，链接域名单独作为特征"""
+    normalized = VerdictCache.normalize_text(text)
+    tokens = {f"url:{host}" for host in extract_hosts(normalized)}
+    tokens.update(iter_terms(normalized))
+    return tokens
+
+def _count_tokens(texts) -> dict:
+    counts = {}
+    for text in texts:
+        for token in tokenize(text):
+            counts[token] = counts.get(token, 0) + 1
+    return counts
+
+class LocalFilter:
+    """在调用 AI 提供商之前的本地预过滤。
+
+    依次检查关键词/正则、链接域名黑名单和朴素贝叶斯模型；能明确判定为垃圾或正常的消息
+    直接给出结果，其余返回 None 交给 AI 审查。贝叶斯模型的垃圾样本定期从 filtered_messages
+    重新加载，正常样本来自 AI 提供商判定为正常的文本消息。
+    """
+
+    # 正常样本文档数超过该值时所有计数减半，控制内存并让模型偏向近期消息
+    MAX_HAM_DOCS = 10000
+
+    def __init__(self, keywords=(), blocked_domains=(), spam_threshold: float = 0.99,
+                 ham_threshold: float = 0.01, min_samples: int = 50, retrain_interval: float = 600,
+                 enabled: bool = True):
+        self.enabled = enabled
+        self.spam_threshold = spam_threshold
+        self.ham_threshold = ham_threshold
+        self.min_samples = min_samples
+        self.retrain_interval = retrain_interval
+        self.blocked_domains = set(blocked_domains)
+        self._keyword_re = self._compile_keywords(keywords)
+
+        self._spam_counts = {}
+        self._spam_docs = 0
+        self._ham_counts = {}
+        self._ham_docs = 0
+        self._last_train = None
+        self._train_task = None
+        self._closed = False
+
+        self.stats_counter = {"keyword": 0, "domain": 0, "bayes_spam": 0, "bayes_ham": 0, "passed": 0}
+
+    @staticmethod
+    def _compile_keywords(keywords):
+        patterns = []
+        literals = []
+        for keyword in keywords:
+            if keyword.startswith('re:'):
+                patterns.append(keyword[3:])
+            else:
+                literals.append(re.escape(VerdictCache.normalize_text(keyword)))
+        # 字面关键词按长度降序，合并成一个正则一次扫描完成
+        literals.sort(key=len, reverse=True)
+        alternatives = literals + patterns
+        if not alternatives:
+            return None
+        return re.compile('|'.join(f'(?:{p})' for p in alternatives), re.IGNORECASE)
+
+    def _is_blocked_host(self, host: str) -> bool:
+        parts = host.split('.')
+        return any('.'.join(parts[i:]) in self.blocked_domains for i in range(len(parts) - 1))
+
+    def spam_probability(self, tokens) -> float:
+        """两类先验取相同值；样本不足或没有已知特征时返回 None"""
+        if self._spam_docs < self.min_samples or self._ham_docs < self.min_samples:
+            return None
+        log_ratio = 0.0
+        informative = False
+        for token in tokens:
+            spam = self._spam_counts.get(token, 0)
+            ham = self._ham_counts.get(token, 0)
+            if not spam and not ham:
+                continue
+            informative = True
+            log_ratio += math.log((spam + 1) / (self._spam_docs + 2)) - math.log((ham + 1) / (self._ham_docs + 2))
+        if not informative:
+            return None
+        if log_ratio > 50:
+            return 1.0
+        if log_ratio < -50:
+            return 0.0
+        return 1 / (1 + math.exp(-log_ratio))
+
+    def _decide(self, kind: str, is_spam: bool, reason: str) -> dict:
+        self.stats_counter[kind] += 1
+        return {"is_spam": is_spam, "reason": LOCAL_REASON_PREFIX + reason}
+
+    def classify(self, text: str, urls=(), has_media: bool = False) -> dict:
+        """返回本地判定结果；无法确定时返回 None。带图片的消息只会被本地判定为垃圾，不会被放行"""
+        if not self.enabled or not (text or urls):
+            return None
+        self._maybe_retrain()
+
+        normalized = VerdictCache.normalize_text(text)
+        if self._keyword_re and (
+            self._keyword_re.search(normalized) or self._keyword_re.search(normalized.replace(' ', ''))
+        ):
+            return self._decide("keyword", True, "包含违禁关键词。")
+
+        if self.blocked_domains:
+            hosts = extract_hosts(normalized)
+            for url in urls:
+                hosts |= extract_hosts(url)
+            if any(self._is_blocked_host(host) for host in hosts):
+                return self._decide("domain", True, "包含被屏蔽的链接。")
+
+        probability = self.spam_probability(tokenize(text))
+        if probability is not None:
+            if probability >= self.spam_threshold:
+                return self._decide("bayes_spam", True, "疑似垃圾信息。")
+            if probability <= self.ham_threshold and not has_media:
+                return self._decide("bayes_ham", False, "内容未发现违规。")
+
+        self.stats_counter["passed"] += 1
+        return None
+
+    def learn_ham(self, text: str):
+        tokens = tokenize(text)
+        if not tokens:
+            return
+        for token in tokens:
+            self._ham_counts[token] = self._ham_counts.get(token, 0) + 1
+        self._ham_docs += 1
+        if self._ham_docs > self.MAX_HAM_DOCS:
+            self._ham_counts = {t: c // 2 for t, c in self._ham_counts.items() if c > 1}
+            self._ham_docs //= 2
+
+    def _maybe_retrain(self):
+        if self._closed or (self._train_task is not None and not self._train_task.done()):
+            return
+        if self._last_train is not None and time.monotonic() - self._last_train < self.retrain_interval:
+            return
+        self._last_train = time.monotonic()
+        self._train_task = asyncio.get_running_loop().create_task(self.retrain())
+
+    async def retrain(self):
+        try:
+            texts = await db.get_filtered_message_texts(exclude_reason_prefix=LOCAL_REASON_PREFIX)
+            counts = await asyncio.to_thread(_count_tokens, texts)
+            self._spam_counts, self._spam_docs = counts, len(texts)
+        except Exception as e:
+            print(f"本地过滤模型训练失败: {e}")
+
+    async def close(self):
+        """取消并等待后台训练任务，关闭数据库前调用"""
+        self._closed = True
+        if self._train_task is not None:
+            self._train_task.cancel()
+            await asyncio.gather(self._train_task, return_exceptions=True)
+
+    def stats(self) -> dict:
+        return {
+            **self.stats_counter,
+            "spam_samples": self._spam_docs,
+            "ham_samples": self._ham_docs,
+        }
+
+local_filter = LocalFilter(
+    keywords=config.LOCAL_FILTER_KEYWORDS,
+    blocked_domains=config.LOCAL_FILTER_BLOCKED_DOMAINS,
+    spam_threshold=config.LOCAL_FILTER_SPAM_THRESHOLD,
+    ham_threshold=config.LOCAL_FILTER_HAM_THRESHOLD,
+    min_samples=config.LOCAL_FILTER_MIN_SAMPLES,
+    retrain_interval=config.LOCAL_FILTER_RETRAIN_INTERVAL,
+    enabled=config.LOCAL_FILTER_ENABLED
+)
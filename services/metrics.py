@@ -0,0 +1,66 @@
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+
+class LatencyHistogram:
+    """固定分桶的耗时直方图（毫秒），分位数按所在桶的上界估算；超过最大分桶的样本按最大分桶计。"""
+
+    BUCKETS_MS = (50, 100, 250, 500, 1000, 2500, 5000, 10000, 30000)
+
+    def __init__(self):
+        self.buckets = [0] * (len(self.BUCKETS_MS) + 1)
+        self.count = 0
+        self.total_ms = 0.0
+
+    def observe(self, seconds: float):
+        ms = seconds * 1000
+        self.buckets[bisect_left(self.BUCKETS_MS, ms)] += 1
+        self.count += 1
+        self.total_ms += ms
+
+    def percentile(self, q: float) -> float:
+        if not self.count:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        for i, n in enumerate(self.buckets):
+            seen += n
+            if seen >= rank:
+                break
+        return float(self.BUCKETS_MS[min(i, len(self.BUCKETS_MS) - 1)])
+
+    @property
+    def mean_ms(self) -> float:
+        return self.total_ms / self.count if self.count else 0.0
+
+class Metrics:
+    """进程内计数器和耗时直方图，供管理面板的运行指标页展示。"""
+
+    def __init__(self):
+        self.counters = {}
+        self.histograms = {}
+
+    def incr(self, name: str, value: int = 1):
+        self.counters[name] = self.counters.get(name, 0) + value
+
+    def count(self, name: str) -> int:
+        return self.counters.get(name, 0)
+
+    def histogram(self, name: str) -> LatencyHistogram:
+        histogram = self.histograms.get(name)
+        if histogram is None:
+            histogram = self.histograms[name] = LatencyHistogram()
+        return histogram
+
+    def observe(self, name: str, seconds: float):
+        self.histogram(name).observe(seconds)
+
+    @contextmanager
+    def timer(self, name: str):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start)
+
+metrics = Metrics()
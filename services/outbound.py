@@ -0,0 +1,170 @@
+import asyncio
+import heapq
+import itertools
+import time
+from datetime import timedelta
+from telegram.error import RetryAfter
+from config import config
+from services.metrics import metrics
+
+# 优先级通道，数值越小越先发送
+LANE_ADMIN = 0
+LANE_USER = 1
+LANE_RSS = 2
+
+_LANE_NAMES = {LANE_ADMIN: 'admin', LANE_USER: 'user', LANE_RSS: 'rss'}
+
+class TokenBucket:
+    __slots__ = ('rate', 'capacity', 'tokens', 'updated')
+
+    def __init__(self, rate: float, capacity: float, now: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = now
+
+    def _refill(self, now: float):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def delay(self, now: float) -> float:
+        """距离下一个令牌可用还需等待的秒数"""
+        self._refill(now)
+        return 0.0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+    def take(self, now: float):
+        self._refill(now)
+        self.tokens -= 1
+
+    def reserve(self, now: float) -> float:
+        """预定一个令牌（允许透支），返回需要等待的秒数"""
+        self.take(now)
+        return 0.0 if self.tokens >= 0 else -self.tokens / self.rate
+
+    def is_full(self, now: float) -> bool:
+        self._refill(now)
+        return self.tokens >= self.capacity
+
+class OutboundDispatcher:
+    """所有主要 Bot API 发送请求的统一出口。
+
+    每个请求先按目标会话的令牌桶排队（私聊约每秒 1 条，群组每分钟 OUTBOUND_GROUP_RATE_PER_MINUTE 条），
+    再按优先级通道（管理员回复 > 用户消息转发 > RSS）从全局令牌桶（每秒 OUTBOUND_GLOBAL_RATE 条）领取名额。
+    任何请求遇到 RetryAfter 时，所有发送一起暂停对应时长，然后重试该请求。
+    """
+
+    # 单个请求因 RetryAfter 最多重试的次数
+    MAX_RETRY_AFTER = 3
+    # 会话令牌桶数量超过该值时清理已回满（空闲）的桶
+    MAX_CHAT_BUCKETS = 10000
+
+    def __init__(self, global_rate: float = 30, private_rate: float = 1, private_burst: float = 3,
+                 group_rate_per_minute: float = 20):
+        self.global_rate = global_rate
+        self.private_rate = private_rate
+        self.private_burst = private_burst
+        self.group_rate_per_minute = group_rate_per_minute
+        self._global = None
+        self._chat_buckets = {}
+        self._waiters = []
+        self._sequence = itertools.count()
+        self._pump_task = None
+        self._loop = None
+        self._paused_until = 0.0
+        self.sent = {name: 0 for name in _LANE_NAMES.values()}
+        self.retry_after = 0
+
+    def _bind_loop(self):
+        loop = asyncio.get_running_loop()
+        if self._loop is not loop:
+            self._loop = loop
+            # 全局名额不允许突发，均匀发放，任意一秒内都不超过 global_rate 条
+            self._global = TokenBucket(self.global_rate, 1, loop.time())
+            self._chat_buckets = {}
+            self._waiters = []
+            self._pump_task = None
+            self._paused_until = 0.0
+        return loop
+
+    def _chat_bucket(self, chat_id, now: float) -> TokenBucket:
+        bucket = self._chat_buckets.get(chat_id)
+        if bucket is None:
+            if len(self._chat_buckets) >= self.MAX_CHAT_BUCKETS:
+                self._chat_buckets = {key: value for key, value in self._chat_buckets.items() if not value.is_full(now)}
+            # 群组/频道 ID 为负数，也可能以 @username 形式给出
+            if str(chat_id).startswith(('-', '@')):
+                rate = self.group_rate_per_minute / 60
+                bucket = TokenBucket(rate, self.group_rate_per_minute, now)
+            else:
+                bucket = TokenBucket(self.private_rate, self.private_burst, now)
+            self._chat_buckets[chat_id] = bucket
+        return bucket
+
+    def pause(self, seconds: float):
+        loop = self._bind_loop()
+        self._paused_until = max(self._paused_until, loop.time() + seconds)
+
+    async def _acquire(self, lane: int, chat_id):
+        loop = self._bind_loop()
+        delay = self._chat_bucket(chat_id, loop.time()).reserve(loop.time())
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+        future = loop.create_future()
+        heapq.heappush(self._waiters, (lane, next(self._sequence), future))
+        if self._pump_task is None or self._pump_task.done():
+            self._pump_task = loop.create_task(self._pump())
+        await future
+
+    async def _pump(self):
+        loop = asyncio.get_running_loop()
+        while self._waiters:
+            now = loop.time()
+            wait = max(self._paused_until - now, self._global.delay(now))
+            if wait > 0:
+                await asyncio.sleep(wait)
+                continue
+            _, _, future = heapq.heappop(self._waiters)
+            if future.done():
+                continue
+            self._global.take(now)
+            future.set_result(None)
+
+    async def send(self, lane: int, chat_id, factory):
+        """factory() 返回实际的 Bot API 调用协程；返回其结果，RetryAfter 以外的异常原样抛出"""
+        start = time.perf_counter()
+        for attempt in range(self.MAX_RETRY_AFTER + 1):
+            await self._acquire(lane, chat_id)
+            try:
+                result = await factory()
+            except RetryAfter as e:
+                retry_after = e.retry_after
+                seconds = retry_after.total_seconds() if isinstance(retry_after, timedelta) else float(retry_after)
+                self.retry_after += 1
+                self.pause(seconds)
+                print(f"触发 Telegram 限流，全部发送暂停 {seconds:.0f} 秒")
+                if attempt >= self.MAX_RETRY_AFTER:
+                    raise
+                continue
+            lane_name = _LANE_NAMES.get(lane, 'user')
+            self.sent[lane_name] += 1
+            metrics.observe(f'outbound.{lane_name}', time.perf_counter() - start)
+            return result
+
+    def stats(self) -> dict:
+        paused = 0.0
+        if self._loop is not None:
+            paused = max(0.0, self._paused_until - self._loop.time())
+        return {
+            "waiting": len(self._waiters),
+            "chats": len(self._chat_buckets),
+            "paused": paused,
+            "retry_after": self.retry_after,
+            "sent": dict(self.sent),
+        }
+
+outbound = OutboundDispatcher(
+    global_rate=config.OUTBOUND_GLOBAL_RATE,
+    private_rate=config.OUTBOUND_PRIVATE_RATE,
+    group_rate_per_minute=config.OUTBOUND_GROUP_RATE_PER_MINUTE
+)
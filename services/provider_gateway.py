@@ -0,0 +1,200 @@
+import asyncio
+import time
+from config import config
+from services.metrics import metrics
+
+class CircuitOpenError(Exception):
+    """熔断器处于打开状态，本次调用未发出"""
+
+class CircuitBreaker:
+    """连续失败（异常、超时或耗时超过 slow_call_seconds）达到阈值后打开，
+    冷却 cooldown 秒后进入半开状态，只放行一个探测请求，成功则关闭，失败则重新打开。"""
+
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half_open'
+
+    def __init__(self, failure_threshold: int = 5, cooldown: float = 30, slow_call_seconds: float = 10):
+        self.failure_threshold = failure_threshold
+        self.cooldown = cooldown
+        self.slow_call_seconds = slow_call_seconds
+        self.state = self.CLOSED
+        self.consecutive_failures = 0
+        self.opened_at = 0.0
+        self.open_count = 0
+        self._probe_in_flight = False
+
+    def is_open(self) -> bool:
+        if self.state == self.OPEN and time.monotonic() - self.opened_at >= self.cooldown:
+            self.state = self.HALF_OPEN
+        return self.state == self.OPEN or (self.state == self.HALF_OPEN and self._probe_in_flight)
+
+    def allow(self) -> bool:
+        if self.is_open():
+            return False
+        if self.state == self.HALF_OPEN:
+            self._probe_in_flight = True
+        return True
+
+    def record_success(self, elapsed: float):
+        if elapsed > self.slow_call_seconds:
+            self.record_failure()
+            return
+        self._probe_in_flight = False
+        self.consecutive_failures = 0
+        self.state = self.CLOSED
+
+    def record_failure(self):
+        self._probe_in_flight = False
+        self.consecutive_failures += 1
+        if self.state == self.HALF_OPEN or self.consecutive_failures >= self.failure_threshold:
+            if self.state != self.OPEN:
+                self.open_count += 1
+                print(f"AI 提供商熔断器打开，{self.cooldown:.0f} 秒后重试")
+            self.state = self.OPEN
+            self.opened_at = time.monotonic()
+
+class ProviderGateway:
+    """所有 AI 提供商请求的统一出口：全局并发上限（MAX_WORKERS）、排队超时（QUEUE_TIMEOUT）、
+    单次调用超时（AI_CALL_TIMEOUT），以及按提供商区分的熔断器。"""
+
+    def __init__(self, max_concurrency: int = 5, queue_timeout: float = 30, call_timeout: float = 20,
+                 failure_threshold: int = 5, cooldown: float = 30, slow_call_seconds: float = 10):
+        self.max_concurrency = max(1, max_concurrency)
+        self.queue_timeout = queue_timeout
+        self.call_timeout = call_timeout
+        self._breaker_args = (failure_threshold, cooldown, slow_call_seconds)
+        self._breakers = {}
+        self._semaphore = None
+        self._loop = None
+        self.in_flight = 0
+        self.waiting = 0
+
+    def breaker(self, provider_name: str) -> CircuitBreaker:
+        breaker = self._breakers.get(provider_name)
+        if breaker is None:
+            breaker = self._breakers[provider_name] = CircuitBreaker(*self._breaker_args)
+        return breaker
+
+    def is_available(self, provider_name: str) -> bool:
+        return not self.breaker(provider_name).is_open()
+
+    def _get_semaphore(self) -> asyncio.Semaphore:
+        loop = asyncio.get_running_loop()
+        if self._loop is not loop:
+            self._loop = loop
+            self._semaphore = asyncio.Semaphore(self.max_concurrency)
+        return self._semaphore
+
+    async def _acquire(self, provider_name: str, breaker: CircuitBreaker) -> asyncio.Semaphore:
+        if not breaker.allow():
+            metrics.incr('gateway.rejected')
+            raise CircuitOpenError(provider_name)
+
+        semaphore = self._get_semaphore()
+        wait_start = time.perf_counter()
+        self.waiting += 1
+        try:
+            await asyncio.wait_for(semaphore.acquire(), self.queue_timeout)
+        except asyncio.TimeoutError:
+            metrics.incr('gateway.queue_timeouts')
+            # 没有真正发出请求，不计入熔断，但要释放半开状态的探测名额
+            breaker._probe_in_flight = False
+            raise
+        finally:
+            self.waiting -= 1
+        metrics.observe('gateway.queue_wait', time.perf_counter() - wait_start)
+        return semaphore
+
+    async def call(self, provider_name: str, factory, is_failure=None, timeout: float = None):
+        """factory() 返回要执行的协程。is_failure(result) 为真时，结果照常返回但计入熔断失败。
+
+        熔断打开时抛出 CircuitOpenError，排队或调用超时抛出 asyncio.TimeoutError。
+        """
+        breaker = self.breaker(provider_name)
+        semaphore = await self._acquire(provider_name, breaker)
+
+        self.in_flight += 1
+        start = time.perf_counter()
+        try:
+            result = await asyncio.wait_for(factory(), timeout or self.call_timeout)
+        except asyncio.TimeoutError:
+            metrics.incr('gateway.timeouts')
+            breaker.record_failure()
+            raise
+        except asyncio.CancelledError:
+            breaker._probe_in_flight = False
+            raise
+        except Exception:
+            metrics.incr('gateway.errors')
+            breaker.record_failure()
+            raise
+        finally:
+            self.in_flight -= 1
+            semaphore.release()
+
+        elapsed = time.perf_counter() - start
+        metrics.observe(f'gateway.{provider_name}', elapsed)
+        if is_failure is not None and is_failure(result):
+            metrics.incr('gateway.errors')
+            breaker.record_failure()
+        else:
+            breaker.record_success(elapsed)
+        return result
+
+    async def stream(self, provider_name: str, factory, timeout: float = None):
+        """流式调用：factory() 返回异步生成器，逐段转发其输出。
+
+        timeout 限制的是相邻两段之间的等待时间，熔断按首段到达的耗时判断是否过慢；
+        整个流结束（或调用方提前停止读取）后才释放并发名额。
+        """
+        breaker = self.breaker(provider_name)
+        semaphore = await self._acquire(provider_name, breaker)
+
+        self.in_flight += 1
+        start = time.perf_counter()
+        first_chunk_elapsed = None
+        chunks = factory()
+        try:
+            while True:
+                try:
+                    chunk = await asyncio.wait_for(chunks.__anext__(), timeout or self.call_timeout)
+                except StopAsyncIteration:
+                    break
+                if first_chunk_elapsed is None:
+                    first_chunk_elapsed = time.perf_counter() - start
+                    metrics.observe(f'gateway.{provider_name}.first_chunk', first_chunk_elapsed)
+                yield chunk
+        except asyncio.TimeoutError:
+            metrics.incr('gateway.timeouts')
+            breaker.record_failure()
+            raise
+        except (asyncio.CancelledError, GeneratorExit):
+            breaker._probe_in_flight = False
+            raise
+        except Exception:
+            metrics.incr('gateway.errors')
+            breaker.record_failure()
+            raise
+        else:
+            breaker.record_success(first_chunk_elapsed if first_chunk_elapsed is not None else time.perf_counter() - start)
+        finally:
+            await chunks.aclose()
+            self.in_flight -= 1
+            semaphore.release()
+
+    def stats(self) -> dict:
+        return {
+            "in_flight": self.in_flight,
+            "waiting": self.waiting,
+            "breakers": {name: breaker.state for name, breaker in self._breakers.items()},
+        }
+
+provider_gateway = ProviderGateway(
+    max_concurrency=config.MAX_WORKERS,
+    queue_timeout=config.QUEUE_TIMEOUT,
+    call_timeout=config.AI_CALL_TIMEOUT,
+    failure_threshold=config.AI_BREAKER_FAILURE_THRESHOLD,
+    cooldown=config.AI_BREAKER_COOLDOWN,
+    slow_call_seconds=config.AI_SLOW_CALL_SECONDS
+)
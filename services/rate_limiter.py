@@ -1,40 +1,49 @@
-import asyncio
 import time
-from collections import defaultdict, deque
 from config import config
+from database.session_store import session_store
 
 class RateLimiter:
-    def __init__(self):
-        self.user_message_timestamps = defaultdict(lambda: deque())
-        self.max_messages_per_minute = config.MAX_MESSAGES_PER_MINUTE
-        self.user_warnings = {}
-        self.lock = asyncio.Lock()
-    
+    """按用户限制每分钟消息数的 GCRA（通用信元速率算法）限流器。
+
+    每个用户只保存一个"理论到达时间"和是否已警告，允许在 60 秒内突发 max_messages_per_minute 条，
+    之后每 60/max_messages_per_minute 秒恢复一条。状态保存在会话存储中，以理论到达时间作为过期时间：
+    过期即表示该用户已完全恢复，条目可以直接丢弃。读取-修改-写回由 store.update() 保证原子性。
+    """
+
+    KIND = 'rate_limit'
+
+    def __init__(self, max_messages_per_minute: int = None, store=None):
+        self.max_messages_per_minute = max_messages_per_minute or config.MAX_MESSAGES_PER_MINUTE
+        self.emission_interval = 60.0 / self.max_messages_per_minute
+        self.burst_tolerance = 60.0 - self.emission_interval
+        self.store = store or session_store
+
     async def check_user_rate_limit(self, user_id: int) -> tuple[bool, bool]:
-        async with self.lock:
-            now = time.time()
-            timestamps = self.user_message_timestamps[user_id]
-            while timestamps and timestamps[0] < now - 60.0:
-                timestamps.popleft()
-            is_over_limit = len(timestamps) >= self.max_messages_per_minute
-            if is_over_limit:
-                was_warned = self.user_warnings.get(user_id, False)
-                return True, was_warned
-            else:
-                timestamps.append(now)
-                if user_id in self.user_warnings:
-                    del self.user_warnings[user_id]
-                return False, False
-    
+        """返回 (是否超限, 超限前是否已警告过)；未超限时记录本条消息并清除警告"""
+        now = time.time()
+
+        def apply(state):
+            tat, warned = state if state is not None else (now, False)
+            tat = max(tat, now)
+            if tat - now > self.burst_tolerance:
+                return (tat, warned), tat, (True, warned)
+            tat += self.emission_interval
+            return (tat, False), tat, (False, False)
+
+        return await self.store.update(self.KIND, user_id, apply)
+
     async def mark_user_warned(self, user_id: int):
-        async with self.lock:
-            self.user_warnings[user_id] = True
-    
+        def apply(state):
+            if state is None:
+                return None, 0, None
+            return (state[0], True), state[0], None
+
+        await self.store.update(self.KIND, user_id, apply)
+
     async def clear_user_warning(self, user_id: int):
-        async with self.lock:
-            if user_id in self.user_warnings:
-                del self.user_warnings[user_id]
-            if user_id in self.user_message_timestamps:
-                del self.user_message_timestamps[user_id]
+        await self.store.delete(self.KIND, user_id)
+
+    def stats(self) -> dict:
+        return {"tracked_users": self.store.stats()['entries'].get(self.KIND, 0)}
 
 rate_limiter = RateLimiter()
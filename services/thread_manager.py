@@ -5,6 +5,7 @@ from database import models as db
 from config import config
 from datetime import datetime
 from utils.message_sender import send_message_by_type
+from services.topic_state import topic_state
 
 async def get_or_create_thread(update: Update, context: ContextTypes.DEFAULT_TYPE) -> tuple[int, bool]:
     user = update.effective_user
@@ -20,6 +21,7 @@ async def get_or_create_thread(update: Update, context: ContextTypes.DEFAULT_TYP
             name=topic_name
         )
         thread_id = topic.message_thread_id
+        topic_state.mark_valid(thread_id)
         
         await db.update_user_thread_id(user.id, thread_id)
         
@@ -0,0 +1,74 @@
+import time
+from collections import OrderedDict
+from config import config
+
+# 发送到已删除或已关闭的话题时 Telegram 返回的错误信息片段（小写）
+_INVALID_TOPIC_ERRORS = ("thread not found", "topic not found", "topic_closed", "topic_deleted")
+
+def is_invalid_topic_error(error_message: str) -> bool:
+    error_message = (error_message or "").lower()
+    return any(fragment in error_message for fragment in _INVALID_TOPIC_ERRORS)
+
+class TopicStateTracker:
+    """话题群组中各话题是否仍可用的进程内记录。
+
+    状态来自话题关闭/重新打开的服务消息，以及向话题发送消息的结果（成功、
+    "thread not found" 或被落到了其他话题），按 TTL 过期。过期或从未记录的话题视为未知，
+    由下一次真实发送的结果来确定，不再为此额外请求 Bot API。
+    """
+
+    def __init__(self, ttl: float = 3600, max_entries: int = 10000):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._states = OrderedDict()
+        self.invalidations = 0
+        self.recoveries = 0
+
+    def get(self, thread_id: int):
+        """返回 True（可用）、False（已失效）或 None（未知）"""
+        entry = self._states.get(thread_id)
+        if entry is None:
+            return None
+        valid, expires_at = entry
+        if expires_at <= time.monotonic():
+            del self._states[thread_id]
+            return None
+        return valid
+
+    def _set(self, thread_id: int, valid: bool):
+        self._states[thread_id] = (valid, time.monotonic() + self.ttl)
+        self._states.move_to_end(thread_id)
+        while len(self._states) > self.max_entries:
+            self._states.popitem(last=False)
+
+    def mark_valid(self, thread_id: int):
+        self._set(thread_id, True)
+
+    def mark_invalid(self, thread_id: int):
+        self.invalidations += 1
+        self._set(thread_id, False)
+
+    def record_failure(self, thread_id: int):
+        """真实发送时发现话题已失效"""
+        self.recoveries += 1
+        self.mark_invalid(thread_id)
+
+    def record_send(self, thread_id: int, sent_message) -> bool:
+        """根据发送结果更新状态；消息没有落在目标话题中（话题已被删除）时返回 False"""
+        if sent_message is not None and getattr(sent_message, 'message_thread_id', None) != thread_id:
+            self.record_failure(thread_id)
+            return False
+        self.mark_valid(thread_id)
+        return True
+
+    def stats(self) -> dict:
+        now = time.monotonic()
+        live = [valid for valid, expires_at in self._states.values() if expires_at > now]
+        return {
+            "valid": sum(1 for valid in live if valid),
+            "invalid": sum(1 for valid in live if not valid),
+            "invalidations": self.invalidations,
+            "recoveries": self.recoveries,
+        }
+
+topic_state = TopicStateTracker(config.TOPIC_STATE_TTL)
@@ -0,0 +1,129 @@
+import hashlib
+import json
+import re
+import time
+import unicodedata
+from collections import OrderedDict
+from config import config
+from database.db_manager import db_manager
+from database.write_queue import write_queue
+
+_WHITESPACE_RE = re.compile(r'\s+')
+
+class VerdictCache:
+    """内容审查结果缓存。
+
+    键由归一化文本的哈希、图片摘要和当前审查模型名组成。内存中按 LRU + TTL
+    保存，可选写入 SQLite 的 moderation_verdicts 表，重启后继续命中。送审文本被裁剪过时，
+    裁剪记录（input_budget）随结果一起保存。
+    """
+
+    # 每写入这么多条持久化记录，顺带清理一次已过期的行
+    PURGE_EVERY = 1000
+
+    def __init__(self, max_entries: int = 5000, ttl: float = 86400, persist: bool = True):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.persist = persist
+        self._data = OrderedDict()
+        self._puts_since_purge = 0
+        self.hits = 0
+        self.persisted_hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def normalize_text(text: str) -> str:
+        if not text:
+            return ""
+        text = unicodedata.normalize('NFKC', text).lower()
+        return _WHITESPACE_RE.sub(' ', text).strip()
+
+    def make_key(self, text: str, image_bytes: bytes, model_name: str, media_id: str = None) -> str:
+        """media_id 为 Telegram 的 file_unique_id，给出时用它代替图片摘要，无需先下载图片"""
+        digest = hashlib.sha256()
+        digest.update(model_name.encode('utf-8'))
+        digest.update(b'\0')
+        digest.update(self.normalize_text(text).encode('utf-8'))
+        digest.update(b'\0')
+        if media_id:
+            digest.update(b'media:' + media_id.encode('utf-8'))
+        elif image_bytes:
+            digest.update(hashlib.sha256(image_bytes).digest())
+        return digest.hexdigest()
+
+    async def get(self, key: str):
+        now = time.time()
+        entry = self._data.get(key)
+        if entry is not None:
+            verdict, expires_at = entry
+            if expires_at > now:
+                self._data.move_to_end(key)
+                self.hits += 1
+                return dict(verdict)
+            del self._data[key]
+
+        if self.persist:
+            async with db_manager.get_connection() as db:
+                async with db.execute(
+                    'SELECT is_spam, reason, expires_at, input_budget FROM moderation_verdicts WHERE cache_key = ? AND expires_at > ?',
+                    (key, now)
+                ) as cursor:
+                    row = await cursor.fetchone()
+            if row:
+                verdict = {"is_spam": bool(row[0]), "reason": row[1]}
+                if row[3]:
+                    verdict["input_budget"] = json.loads(row[3])
+                self._remember(key, verdict, row[2])
+                self.persisted_hits += 1
+                return dict(verdict)
+
+        self.misses += 1
+        return None
+
+    def _remember(self, key: str, verdict: dict, expires_at: float):
+        self._data[key] = (verdict, expires_at)
+        self._data.move_to_end(key)
+        while len(self._data) > self.max_entries:
+            self._data.popitem(last=False)
+
+    async def put(self, key: str, verdict: dict):
+        if self.max_entries <= 0:
+            return
+        input_budget = verdict.get("input_budget")
+        verdict = {"is_spam": bool(verdict.get("is_spam")), "reason": verdict.get("reason")}
+        if input_budget:
+            verdict["input_budget"] = input_budget
+        expires_at = time.time() + self.ttl
+        self._remember(key, verdict, expires_at)
+
+        if self.persist:
+            write_queue.submit(
+                'moderation_verdicts',
+                'INSERT OR REPLACE INTO moderation_verdicts (cache_key, is_spam, reason, expires_at, input_budget) VALUES (?, ?, ?, ?, ?)',
+                (key, 1 if verdict["is_spam"] else 0, verdict["reason"], expires_at,
+                 json.dumps(input_budget) if input_budget else None)
+            )
+            self._puts_since_purge += 1
+            if self._puts_since_purge >= self.PURGE_EVERY:
+                self._puts_since_purge = 0
+                write_queue.submit(
+                    'moderation_verdicts',
+                    'DELETE FROM moderation_verdicts WHERE expires_at <= ?',
+                    (time.time(),)
+                )
+
+    def stats(self) -> dict:
+        total = self.hits + self.persisted_hits + self.misses
+        return {
+            "entries": len(self._data),
+            "hits": self.hits,
+            "persisted_hits": self.persisted_hits,
+            "misses": self.misses,
+            "hit_rate": (self.hits + self.persisted_hits) / total if total else 0.0,
+        }
+
+verdict_cache = VerdictCache(
+    max_entries=config.VERDICT_CACHE_SIZE,
+    ttl=config.VERDICT_CACHE_TTL,
+    persist=config.VERDICT_CACHE_PERSIST
+)
@@ -1,30 +1,50 @@
-import time
 import io
 from telegram import InlineKeyboardButton, InlineKeyboardMarkup
 from database import models as db
+from database.session_store import session_store, SessionRecord
 from config import config
-from services.gemini_service import gemini_service
+from services.captcha_engine import captcha_engine
+from services.challenge_pool import challenge_pool
 from services.cloudflare_service import verify_cloudflare_token
 
-pending_verifications = {}
-pending_image_verifications = {}
-pending_cloudflare_verifications = {}  # 存储待处理的 Cloudflare 验证
+# 会话存储中各类验证会话的 kind
+KIND_TEXT = 'verification'
+KIND_IMAGE = 'image_verification'
+KIND_CLOUDFLARE = 'cloudflare_verification'  # 由 cloudflare_web 进程完成校验
+
+async def _save_session(kind: str, user_id: int, session: SessionRecord):
+    await session_store.set(kind, user_id, session, session.expires_at)
+
+def _count_attempt(session):
+    """session_store.update() 的回调：尝试次数加一"""
+    if session is None:
+        return None, 0, None
+    session.attempts += 1
+    return session, session.expires_at, session
+
+async def _get_pending(kind: str, user_id: int):
+    """返回未超时的会话，已超时的会话顺带删除"""
+    session = await session_store.get(kind, user_id)
+    if session is not None and session.is_expired():
+        await session_store.delete(kind, user_id)
+        return None
+    return session
 
 async def create_verification(user_id: int):
-    challenge = await gemini_service.generate_verification_challenge()
+    challenge = challenge_pool.get()
     question = challenge['question']
     correct_answer = challenge['correct_answer']
     options = challenge['options']
     
-    existing_attempts = pending_verifications.get(user_id, {}).get('attempts', 0)
+    existing = await session_store.get(KIND_TEXT, user_id)
+    existing_attempts = existing.attempts if existing else 0
     
-    pending_verifications[user_id] = {
-        'answer': correct_answer,
-        'question': question,
-        'options': options,
-        'attempts': existing_attempts,
-        'created_at': time.time()
-    }
+    await _save_session(KIND_TEXT, user_id, SessionRecord(
+        answer=correct_answer,
+        question=question,
+        options=options,
+        attempts=existing_attempts
+    ))
     
     keyboard = [
         [InlineKeyboardButton(option, callback_data=f"verify_{option}") for option in options]
@@ -35,15 +55,14 @@ async def create_verification(user_id: int):
 async def create_image_verification(user_id: int):
     """创建图片验证码"""
     import io
-    # 优先使用用户自定义的图片验证码类型（如 image_letters, image_mixed, image_digits）
-        """创建图片验证码，优先使用用户偏好类型，否则使用全局配置"""
-        # 优先使用用户设置的图片验证码类型（digits/letters/mixed），否则使用全局配置
-        try:
-            user_pref = await db.get_user_verification_image_type(user_id)
-        except Exception:
-            user_pref = None
+    # 优先使用用户设置的图片验证码类型（digits/letters/mixed），否则使用全局配置
+    try:
+        user_pref = await db.get_user_verification_image_type(user_id)
+    except Exception:
+        user_pref = None
 
-        captcha_type = user_pref or config.VERIFICATION_IMAGE_CAPTCHA_TYPE
+    captcha_type = user_pref or config.VERIFICATION_IMAGE_CAPTCHA_TYPE
+    # 用户选择的验证方式（如 image_letters, image_mixed, image_digits）优先
     try:
         user_mode = await db.get_user_verification_mode(user_id)
         if user_mode and user_mode.startswith("image"):
@@ -57,20 +76,20 @@ async def create_image_verification(user_id: int):
         # 如果查询失败，回退到全局配置
         pass
 
-    image_verification = await gemini_service.generate_image_verification(captcha_type)
+    image_verification = await captcha_engine.get(captcha_type)
     
     captcha_text = image_verification['captcha_text']
     image_bytes = image_verification['image_bytes']
     options = image_verification['options']
     
-    existing_attempts = pending_image_verifications.get(user_id, {}).get('attempts', 0)
+    existing = await session_store.get(KIND_IMAGE, user_id)
+    existing_attempts = existing.attempts if existing else 0
     
-    pending_image_verifications[user_id] = {
-        'answer': captcha_text,
-        'options': options,
-        'attempts': existing_attempts,
-        'created_at': time.time()
-    }
+    await _save_session(KIND_IMAGE, user_id, SessionRecord(
+        answer=captcha_text,
+        options=options,
+        attempts=existing_attempts
+    ))
     
     # 将bytes转换为BytesIO对象供Telegram使用
     image_io = io.BytesIO(image_bytes)
@@ -88,24 +107,22 @@ async def create_image_verification(user_id: int):
     return image_io, "请输入图片中的验证码：", InlineKeyboardMarkup(keyboard)
 
 async def verify_answer(user_id: int, answer: str):
-    if user_id not in pending_verifications:
+    # 尝试次数的读取和递增在存储内原子完成，并发的多次点击不会少计次数
+    verification = await session_store.update(KIND_TEXT, user_id, _count_attempt)
+    if verification is None:
         return False, "验证已过期或不存在。", False, None
     
-    verification = pending_verifications[user_id]
-    
-    if time.time() - verification['created_at'] > config.VERIFICATION_TIMEOUT:
-        del pending_verifications[user_id]
+    if verification.is_expired():
+        await session_store.delete(KIND_TEXT, user_id)
         return False, "验证超时，请重新发送消息。", False, None
     
-    verification['attempts'] += 1
-    
-    if answer == verification['answer']:
-        del pending_verifications[user_id]
+    if answer == verification.answer:
+        await session_store.delete(KIND_TEXT, user_id)
         await db.update_user_verification(user_id, is_verified=True)
         return True, "验证成功！", False, None
     
-    if verification['attempts'] >= config.MAX_VERIFICATION_ATTEMPTS:
-        del pending_verifications[user_id]
+    if verification.attempts >= config.MAX_VERIFICATION_ATTEMPTS:
+        await session_store.delete(KIND_TEXT, user_id)
         
         await db.add_to_blacklist(user_id, reason="人机验证失败次数过多", blocked_by=config.BOT_ID)
         message = (
@@ -114,46 +131,42 @@ async def verify_answer(user_id: int, answer: str):
         )
         return False, message, True, None
     
-    challenge = await gemini_service.generate_verification_challenge()
+    challenge = challenge_pool.get()
     new_question = challenge['question']
     new_correct_answer = challenge['correct_answer']
     new_options = challenge['options']
     
-    pending_verifications[user_id] = {
-        'answer': new_correct_answer,
-        'question': new_question,
-        'options': new_options,
-        'attempts': verification['attempts'],
-        'created_at': time.time()
-    }
+    await _save_session(KIND_TEXT, user_id, SessionRecord(
+        answer=new_correct_answer,
+        question=new_question,
+        options=new_options,
+        attempts=verification.attempts
+    ))
     
     keyboard = [
         [InlineKeyboardButton(option, callback_data=f"verify_{option}") for option in new_options]
     ]
     
     new_question_text = f"请完成人机验证: \n\n{new_question}"
-    return False, f"答案错误，还有 {config.MAX_VERIFICATION_ATTEMPTS - verification['attempts']} 次机会。", False, (new_question_text, InlineKeyboardMarkup(keyboard))
+    return False, f"答案错误，还有 {config.MAX_VERIFICATION_ATTEMPTS - verification.attempts} 次机会。", False, (new_question_text, InlineKeyboardMarkup(keyboard))
 
 async def verify_image_answer(user_id: int, answer: str):
     """验证图片验证码"""
-    if user_id not in pending_image_verifications:
+    verification = await session_store.update(KIND_IMAGE, user_id, _count_attempt)
+    if verification is None:
         return False, "验证已过期或不存在。", False, None
     
-    verification = pending_image_verifications[user_id]
-    
-    if time.time() - verification['created_at'] > config.VERIFICATION_TIMEOUT:
-        del pending_image_verifications[user_id]
+    if verification.is_expired():
+        await session_store.delete(KIND_IMAGE, user_id)
         return False, "验证超时，请重新发送消息。", False, None
     
-    verification['attempts'] += 1
-    
-    if answer == verification['answer']:
-        del pending_image_verifications[user_id]
+    if answer == verification.answer:
+        await session_store.delete(KIND_IMAGE, user_id)
         await db.update_user_verification(user_id, is_verified=True)
         return True, "验证成功！", False, None
     
-    if verification['attempts'] >= config.MAX_VERIFICATION_ATTEMPTS:
-        del pending_image_verifications[user_id]
+    if verification.attempts >= config.MAX_VERIFICATION_ATTEMPTS:
+        await session_store.delete(KIND_IMAGE, user_id)
         
         await db.add_to_blacklist(user_id, reason="图片验证失败次数过多", blocked_by=config.BOT_ID)
         message = (
@@ -176,18 +189,17 @@ async def verify_image_answer(user_id: int, answer: str):
     except Exception:
         pass
 
-    image_verification = await gemini_service.generate_image_verification(captcha_type)
+    image_verification = await captcha_engine.get(captcha_type)
     
     new_image_bytes = image_verification['image_bytes']
     new_captcha_text = image_verification['captcha_text']
     new_options = image_verification['options']
     
-    pending_image_verifications[user_id] = {
-        'answer': new_captcha_text,
-        'options': new_options,
-        'attempts': verification['attempts'],
-        'created_at': time.time()
-    }
+    await _save_session(KIND_IMAGE, user_id, SessionRecord(
+        answer=new_captcha_text,
+        options=new_options,
+        attempts=verification.attempts
+    ))
     
     # 将bytes转换为BytesIO对象供Telegram使用
     image_io = io.BytesIO(new_image_bytes)
@@ -201,48 +213,27 @@ async def verify_image_answer(user_id: int, answer: str):
          InlineKeyboardButton(new_options[3], callback_data=f"verify_image_{new_options[3]}")]
     ]
     
-    message_text = f"答案错误，还有 {config.MAX_VERIFICATION_ATTEMPTS - verification['attempts']} 次机会。"
+    message_text = f"答案错误，还有 {config.MAX_VERIFICATION_ATTEMPTS - verification.attempts} 次机会。"
     return False, message_text, False, (image_io, "请输入图片中的验证码：", InlineKeyboardMarkup(keyboard))
 
-def is_verification_pending(user_id: int) -> tuple[bool, bool]:
-    if user_id not in pending_verifications:
+async def is_verification_pending(user_id: int) -> tuple[bool, bool]:
+    if await _get_pending(KIND_TEXT, user_id) is None:
         return False, True
-    
-    verification = pending_verifications[user_id]
-    is_expired = time.time() - verification['created_at'] > config.VERIFICATION_TIMEOUT
-    
-    if is_expired:
-        del pending_verifications[user_id]
-        return False, True
-    
     return True, False
 
-def is_image_verification_pending(user_id: int) -> tuple[bool, bool]:
+async def is_image_verification_pending(user_id: int) -> tuple[bool, bool]:
     """检查图片验证是否待处理"""
-    if user_id not in pending_image_verifications:
+    if await _get_pending(KIND_IMAGE, user_id) is None:
         return False, True
-    
-    verification = pending_image_verifications[user_id]
-    is_expired = time.time() - verification['created_at'] > config.VERIFICATION_TIMEOUT
-    
-    if is_expired:
-        del pending_image_verifications[user_id]
-        return False, True
-    
     return True, False
 
-def get_pending_verification_message(user_id: int):
-    if user_id not in pending_verifications:
-        return None
-    
-    verification = pending_verifications[user_id]
-    
-    if time.time() - verification['created_at'] > config.VERIFICATION_TIMEOUT:
-        del pending_verifications[user_id]
+async def get_pending_verification_message(user_id: int):
+    verification = await _get_pending(KIND_TEXT, user_id)
+    if verification is None:
         return None
     
-    question = verification['question']
-    options = verification['options']
+    question = verification.question
+    options = verification.options
     
     keyboard = [
         [InlineKeyboardButton(option, callback_data=f"verify_{option}") for option in options]
@@ -256,10 +247,7 @@ async def create_cloudflare_verification(user_id: int):
     if not config.CLOUDFLARE_TURNSTILE_SITE_KEY:
         return None, "Cloudflare 验证未配置", None
     
-    pending_cloudflare_verifications[user_id] = {
-        'created_at': time.time(),
-        'attempts': 0
-    }
+    await _save_session(KIND_CLOUDFLARE, user_id, SessionRecord())
     
     keyboard = [
         [InlineKeyboardButton(
@@ -282,28 +270,25 @@ async def create_cloudflare_verification(user_id: int):
 
 async def verify_cloudflare_token(user_id: int, token: str):
     """验证 Cloudflare 令牌"""
-    if user_id not in pending_cloudflare_verifications:
+    verification = await session_store.update(KIND_CLOUDFLARE, user_id, _count_attempt)
+    if verification is None:
         return False, "验证已过期或不存在。", False
     
-    verification = pending_cloudflare_verifications[user_id]
-    
-    if time.time() - verification['created_at'] > config.VERIFICATION_TIMEOUT:
-        del pending_cloudflare_verifications[user_id]
+    if verification.is_expired():
+        await session_store.delete(KIND_CLOUDFLARE, user_id)
         return False, "验证超时，请重新发送消息。", False
     
-    verification['attempts'] += 1
-    
     # 验证令牌
     from services.cloudflare_service import verify_cloudflare_token as cf_verify
     is_valid = await cf_verify(token)
     
     if is_valid:
-        del pending_cloudflare_verifications[user_id]
+        await session_store.delete(KIND_CLOUDFLARE, user_id)
         await db.update_user_verification(user_id, is_verified=True)
         return True, "✅ 验证成功！", False
     
-    if verification['attempts'] >= config.MAX_VERIFICATION_ATTEMPTS:
-        del pending_cloudflare_verifications[user_id]
+    if verification.attempts >= config.MAX_VERIFICATION_ATTEMPTS:
+        await session_store.delete(KIND_CLOUDFLARE, user_id)
         await db.add_to_blacklist(
             user_id, 
             reason="Cloudflare 验证失败次数过多", 
@@ -311,19 +296,11 @@ async def verify_cloudflare_token(user_id: int, token: str):
         )
         return False, "❌ 验证失败次数过多，您已被暂时封禁。", True
     
-    return False, f"❌ 验证失败，还有 {config.MAX_VERIFICATION_ATTEMPTS - verification['attempts']} 次机会。", False
+    return False, f"❌ 验证失败，还有 {config.MAX_VERIFICATION_ATTEMPTS - verification.attempts} 次机会。", False
 
 
-def is_cloudflare_verification_pending(user_id: int) -> tuple:
+async def is_cloudflare_verification_pending(user_id: int) -> tuple:
     """检查 Cloudflare 验证是否待处理"""
-    if user_id not in pending_cloudflare_verifications:
-        return False, True
-    
-    verification = pending_cloudflare_verifications[user_id]
-    is_expired = time.time() - verification['created_at'] > config.VERIFICATION_TIMEOUT
-    
-    if is_expired:
-        del pending_cloudflare_verifications[user_id]
+    if await _get_pending(KIND_CLOUDFLARE, user_id) is None:
         return False, True
-    
     return True, False
@@ -1,14 +1,109 @@
 from PIL import Image
+from collections import OrderedDict
+from config import config
+from services.metrics import metrics
+import asyncio
 import io
 
-async def sticker_to_image(file: bytes) -> bytes:
+def prepare_image(data: bytes, max_side: int = 800, quality: int = 85) -> bytes:
+    """把待审查的图片缩小到最长边不超过 max_side，并重新编码为不含 EXIF/ICC 等元数据的 JPEG
+    （同步、CPU 密集，应在线程池中调用）"""
+    with Image.open(io.BytesIO(data)) as img:
+        img.draft('RGB', (max_side, max_side))
+        if img.mode in ('RGBA', 'LA', 'P'):
+            # 透明背景（贴纸）铺白底，避免转成 JPEG 后变成黑色
+            rgba = img.convert('RGBA')
+            img = Image.new('RGB', rgba.size, 'white')
+            img.paste(rgba, mask=rgba.getchannel('A'))
+        elif img.mode != 'RGB':
+            img = img.convert('RGB')
+        img.thumbnail((max_side, max_side), Image.LANCZOS)
+        output_buffer = io.BytesIO()
+        img.save(output_buffer, format='JPEG', quality=quality, optimize=True)
+        return output_buffer.getvalue()
+
+def select_photo_size(photo_sizes, max_side: int = 800):
+    """Telegram 按从小到大给出同一张照片的多个尺寸，取最长边不小于 max_side 的最小尺寸，都不够大时取最大的"""
+    for photo_size in photo_sizes:
+        if max(photo_size.width, photo_size.height) >= max_side:
+            return photo_size
+    return photo_sizes[-1]
+
+class MediaBytesCache:
+    """按 Telegram file_unique_id 缓存已下载并处理好的待审查图片字节，按总字节数做 LRU 淘汰。"""
+
+    def __init__(self, max_bytes: int = 32 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self._data = OrderedDict()
+        self._size = 0
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, file_unique_id: str):
+        data = self._data.get(file_unique_id)
+        if data is None:
+            self.misses += 1
+            return None
+        self._data.move_to_end(file_unique_id)
+        self.hits += 1
+        return data
+
+    def put(self, file_unique_id: str, data: bytes):
+        if not data or len(data) > self.max_bytes:
+            return
+        old = self._data.pop(file_unique_id, None)
+        if old is not None:
+            self._size -= len(old)
+        self._data[file_unique_id] = data
+        self._size += len(data)
+        while self._size > self.max_bytes:
+            _, evicted = self._data.popitem(last=False)
+            self._size -= len(evicted)
+
+    def stats(self) -> dict:
+        total = self.hits + self.misses
+        return {
+            "entries": len(self._data),
+            "bytes": self._size,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / total if total else 0.0,
+        }
+
+media_bytes_cache = MediaBytesCache(config.MEDIA_CACHE_MAX_BYTES)
+
+def get_media_unique_id(message) -> str:
+    """返回需要审查的图片（照片或静态贴纸）的 file_unique_id，没有则返回 None"""
+    if message.photo:
+        return select_photo_size(message.photo, config.MODERATION_IMAGE_MAX_SIDE).file_unique_id
+    if message.sticker and not message.sticker.is_animated and not message.sticker.is_video:
+        return message.sticker.file_unique_id
+    return None
+
+async def load_message_image(message) -> bytes:
+    """下载消息中的照片（足够审查使用的最小尺寸）或静态贴纸，处理为供审查的 JPEG，命中缓存时不再下载"""
+    file_unique_id = get_media_unique_id(message)
+    if not file_unique_id:
+        return None
+
+    image_bytes = media_bytes_cache.get(file_unique_id)
+    if image_bytes is not None:
+        return image_bytes
+
+    if message.photo:
+        media_file = await select_photo_size(message.photo, config.MODERATION_IMAGE_MAX_SIDE).get_file()
+    else:
+        media_file = await message.sticker.get_file()
+    raw_bytes = bytes(await media_file.download_as_bytearray())
     try:
-        with Image.open(io.BytesIO(file)) as img:
-            if img.mode != 'RGB':
-                img = img.convert('RGB')
-            output_buffer = io.BytesIO()
-            img.save(output_buffer, format='PNG')
-            return output_buffer.getvalue()
+        image_bytes = await asyncio.to_thread(
+            prepare_image, raw_bytes, config.MODERATION_IMAGE_MAX_SIDE, config.MODERATION_IMAGE_QUALITY
+        )
     except Exception as e:
-        print(f"Error converting sticker to image: {e}")
+        print(f"处理待审查图片失败: {e}")
         return None
+    metrics.incr('media.downloaded_bytes', len(raw_bytes))
+    metrics.incr('media.prepared_bytes', len(image_bytes))
+
+    media_bytes_cache.put(file_unique_id, image_bytes)
+    return image_bytes
@@ -0,0 +1,15 @@
+import re
+
+_TERM_RE = re.compile(r'[a-z0-9_]+|[㐀-䶿一-鿿]+')
+
+def iter_terms(normalized_text: str):
+    """英文/数字按词切分，中文按相邻两字切分（单个汉字原样保留）。输入应已归一化为小写。"""
+    for run in _TERM_RE.findall(normalized_text):
+        if run[0] > '　':
+            if len(run) == 1:
+                yield run
+            else:
+                for i in range(len(run) - 1):
+                    yield run[i:i + 2]
+        elif len(run) <= 30:
+            yield run
@@ -5,6 +5,8 @@ and notifies the user via the bot.
 import asyncio
 from aiohttp import web
 from config import config
+from database.db_manager import DatabaseManager
+from database.write_queue import write_queue
 from services.verification import verify_cloudflare_token
 from telegram import Bot
 
@@ -66,8 +68,20 @@ async def submit_token(request):
 
     return web.Response(text=message)
 
+async def on_startup(app):
+    # 与 Bot 共用同一个数据库文件；建表语句幂等，先于 Bot 启动时也能正常工作
+    await DatabaseManager(config.DATABASE_PATH).initialize()
+    if config.STATE_BACKEND != 'sqlite':
+        print("警告：STATE_BACKEND 不是 sqlite，本进程无法看到 Bot 创建的 Cloudflare 验证会话")
+
+async def on_cleanup(app):
+    await write_queue.close()
+    await DatabaseManager().close()
+
 def run_app(host='0.0.0.0', port=8080):
     app = web.Application()
+    app.on_startup.append(on_startup)
+    app.on_cleanup.append(on_cleanup)
     app.add_routes([
         web.get('/verify', verify_page),
         web.post('/submit', submit_token),